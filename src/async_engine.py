@@ -0,0 +1,247 @@
+import asyncio
+import collections
+import errno
+import logging
+import threading
+import bt_hid
+from gi.repository import GLib
+
+logger = logging.getLogger(__name__)
+
+def would_block(error):
+    return getattr(error, "errno", None) in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+class AsyncSender(object):
+    """Non-blocking counterpart of bt_hid.Sender, written from the event loop.
+
+    Reports are sent right away when the socket has room, otherwise they are
+    queued until the socket becomes writable again. The overflow policy is
+    the same: stale motion is dropped, transitions are kept up to
+    bt_hid.MAX_QUEUE_DEPTH."""
+
+    def __init__(self, engine, client_sock, max_depth, close_callback=None,
+                 sent_callback=None, first_sent_callback=None):
+        self.engine = engine
+        self.client = client_sock
+        self.max_depth = max_depth
+        self.close_callback = close_callback
+        self.sent_callback = sent_callback
+        self.first_sent_callback = first_sent_callback
+        self.queue = collections.deque()
+        # wait_below() runs on other threads, flush() only takes the lock
+        # when one of them is waiting.
+        self.drained = threading.Condition()
+        self.waiting = 0
+        self.running = True
+        self.writing = False
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.errors = 0
+        self.peak_depth = 0
+
+    def put(self, message, droppable=False, trace=None):
+        if not self.running:
+            return False
+        if len(self.queue) >= self.max_depth and not self.drop_stale():
+            if droppable:
+                self.dropped += 1
+                return False
+        if len(self.queue) >= bt_hid.MAX_QUEUE_DEPTH:
+            logger.warning("Host stopped reading, %d reports queued", bt_hid.MAX_QUEUE_DEPTH)
+            self.errors += 1
+            self.running = False
+            self.queue.clear()
+            self.notify_drained()
+            if self.close_callback:
+                self.close_callback()
+            return False
+        self.queue.append((message, droppable, trace))
+        self.peak_depth = max(self.peak_depth, len(self.queue))
+        if not self.writing:
+            self.flush()
+        return True
+
+    def drop_stale(self):
+        for index, (message, droppable, trace) in enumerate(self.queue):
+            if droppable:
+                del self.queue[index]
+                self.dropped += 1
+                return True
+        return False
+
+    def depth(self):
+        return len(self.queue)
+
+    def wait_below(self, depth):
+        """Block until fewer than depth reports are queued, or the sender
+        stopped. Not from the engine loop, which is what drains the queue."""
+        with self.drained:
+            self.waiting += 1
+            try:
+                while self.running and len(self.queue) >= depth:
+                    self.drained.wait()
+            finally:
+                self.waiting -= 1
+
+    def notify_drained(self):
+        # Reads waiting after the queue changed, and a waiter reads the queue
+        # after raising waiting, so one of them sees the other.
+        if self.waiting:
+            with self.drained:
+                self.drained.notify_all()
+
+    def flush(self):
+        while self.running and self.queue:
+            message, droppable, trace = self.queue[0]
+            try:
+                self.client.send(message)
+            except OSError as e:
+                if would_block(e):
+                    if not self.writing:
+                        self.writing = True
+                        self.engine.loop.add_writer(self.client.fileno(), self.flush)
+                    return
+                logger.info("Write error, connection broken")
+                self.errors += 1
+                self.running = False
+                self.queue.clear()
+                self.notify_drained()
+                if self.close_callback:
+                    self.close_callback()
+                return
+            self.queue.popleft()
+            self.sent += 1
+            self.sent_bytes += len(message)
+            if trace is not None and self.sent_callback:
+                self.sent_callback(trace)
+            if self.sent == 1 and self.first_sent_callback:
+                self.first_sent_callback()
+        self.notify_drained()
+        if self.writing:
+            self.writing = False
+            self.engine.loop.remove_writer(self.client.fileno())
+
+    def close(self):
+        self.running = False
+        self.notify_drained()
+        if self.writing:
+            self.writing = False
+            self.engine.loop.remove_writer(self.client.fileno())
+
+class AsyncEngine(object):
+    """Single threaded event core.
+
+    The libinput fd, both L2CAP listening sockets and every client socket are
+    served by one asyncio loop. The GLib main loop only carries D-Bus traffic
+    (profile registration), so it runs on its own thread."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.glib_loop = None
+        self.glib_thread = None
+        # Accepted channels waiting for their peer.
+        self.pairer = bt_hid.ChannelPairer()
+        self.expire_handle = None
+
+    def call_later(self, delay, callback):
+        return self.loop.call_later(delay, callback)
+
+    def call_soon_threadsafe(self, callback, *args):
+        return self.loop.call_soon_threadsafe(callback, *args)
+
+    def add_input(self, input_device):
+        self.loop.add_reader(input_device.fileno(), input_device.dispatch_pending)
+
+    def add_listener(self, hid_device, accept_callback, close_callback=None):
+        """Accept hosts from hid_device's listening sockets. accept_callback is
+        called with the new client once both channels of a host are up."""
+        for index, sock in enumerate((hid_device.control_sock, hid_device.interrupt_sock)):
+            if sock is None: continue
+            sock.setblocking(False)
+            self.loop.add_reader(sock.fileno(), self.accept_ready, hid_device, sock,
+                                 index, accept_callback, close_callback)
+        if hid_device.profile_channels is not None:
+            self.loop.add_reader(hid_device.profile_channels.fileno(), self.profile_ready,
+                                 hid_device, accept_callback, close_callback)
+
+    def accept_ready(self, hid_device, sock, index, accept_callback, close_callback):
+        try:
+            client_sock, remote_address = hid_device.transport.accept(sock)
+        except OSError as e:
+            if not would_block(e):
+                logger.exception("Accept failed: %s", e)
+            return
+        self.add_channel(hid_device, index, client_sock, remote_address,
+                         accept_callback, close_callback)
+
+    def profile_ready(self, hid_device, accept_callback, close_callback):
+        for client_sock, remote_address in hid_device.profile_channels.get_all():
+            self.add_channel(hid_device, 0, client_sock, remote_address,
+                             accept_callback, close_callback)
+
+    def add_channel(self, hid_device, index, client_sock, remote_address,
+                    accept_callback, close_callback):
+        channels = self.pairer.add(index, client_sock, remote_address)
+        self.schedule_expire()
+        if channels is None:
+            return
+        client = hid_device.create_client(channels[0], channels[1], remote_address,
+                                          close_callback)
+        accept_callback(client)
+
+    def schedule_expire(self):
+        if self.expire_handle is not None:
+            self.expire_handle.cancel()
+            self.expire_handle = None
+        timeout = self.pairer.expire()
+        if timeout is not None:
+            self.expire_handle = self.loop.call_later(timeout, self.schedule_expire)
+
+    def attach_client(self, hid_client):
+        for sock, receiver in ((hid_client.control_client, hid_client.control_client_receiver),
+                               (hid_client.interrupt_client, hid_client.interrupt_client_receiver)):
+            sock.setblocking(False)
+            self.loop.add_reader(sock.fileno(), self.receive_ready, hid_client, sock, receiver)
+        return AsyncSender(self, hid_client.interrupt_client, bt_hid.DEFAULT_QUEUE_DEPTH,
+                           hid_client.client_closed, hid_client.report_sent,
+                           hid_client.first_sent())
+
+    def create_sender(self, sock, close_callback=None):
+        """A sender for replies on a socket attached with attach_client."""
+        return AsyncSender(self, sock, bt_hid.DEFAULT_QUEUE_DEPTH, close_callback)
+
+    def detach_client(self, hid_client):
+        hid_client.interrupt_client_sender.close()
+        if hid_client.control_client_sender is not None:
+            hid_client.control_client_sender.close()
+        for sock in (hid_client.control_client, hid_client.interrupt_client):
+            if sock is not None:
+                self.loop.remove_reader(sock.fileno())
+
+    def receive_ready(self, hid_client, sock, receiver):
+        try:
+            msg = receiver.read()
+        except OSError as e:
+            if would_block(e): return
+            msg = None
+        if not msg:
+            logger.info("Read error, connection broken")
+            hid_client.client_closed()
+            return
+        receiver.dispatch(msg)
+
+    def run_glib(self):
+        self.glib_loop = GLib.MainLoop()
+        self.glib_loop.run()
+
+    def run(self):
+        self.glib_thread = threading.Thread(target=self.run_glib)
+        self.glib_thread.daemon = True
+        self.glib_thread.start()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            if self.glib_loop:
+                self.glib_loop.quit()
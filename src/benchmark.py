@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""Replay an input stream through Forwarder into fake hosts connected over
+the loopback transport, and report throughput, CPU cost and latency.
+
+A recorded stream is a text file with one event per line:
+    <seconds> key <KEY_NAME> <0|1>
+    <seconds> motion <dx> <dy>
+    <seconds> button <BTN_NAME> <0|1>
+    <seconds> wheel <dv> <dh>
+or a recording made with --record, see recording.py.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+import fake_host
+import forwarder
+import latency
+import recording
+import transport
+from libinput.evcodes import Key, Button
+
+logger = logging.getLogger(__name__)
+
+def load_stream(filename):
+    if recording.is_recording(filename):
+        return recording.load_events(filename)
+    events = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"): continue
+            timestamp, event_type, arg1, arg2 = line.split()
+            if event_type == "key":
+                args = (Key[arg1], arg2 == "1")
+            elif event_type == "button":
+                args = (Button[arg1], arg2 == "1")
+            else:
+                args = (float(arg1), float(arg2))
+            events.append((float(timestamp), event_type, args))
+    return events
+
+def synthetic_stream(kind, count):
+    """Generate count events: "typing", "motion" or "mixed"."""
+    letters = [Key["KEY_%s" % chr(c)] for c in range(ord("A"), ord("Z") + 1)]
+    events = []
+    key_events = 0
+    for i in range(count):
+        timestamp = i * 0.001
+        if kind == "typing" or (kind == "mixed" and i % 4 < 2):
+            letter = letters[(key_events // 2) % len(letters)]
+            events.append((timestamp, "key", (letter, key_events % 2 == 0)))
+            key_events += 1
+        else:
+            events.append((timestamp, "motion", (1.5, -0.7)))
+    return events
+
+class ReplayInput(object):
+    """Stand-in for input.Input which replays a list of events."""
+
+    def __init__(self, events, realtime=False):
+        self.events = events
+        self.realtime = realtime
+        self.latency = None
+        self.callbacks = {}
+        # Called with the index of every event before it is dispatched.
+        self.event_hook = None
+        self.batch_begin_callback = None
+        self.batch_end_callback = None
+
+    def register_callbacks(self, key_callback, mouse_move_callback,
+                           mouse_button_callback, mouse_wheel_callback):
+        self.callbacks = {
+            "key": key_callback,
+            "motion": mouse_move_callback,
+            "button": mouse_button_callback,
+            "wheel": mouse_wheel_callback,
+        }
+
+    def register_batch_callbacks(self, batch_begin_callback, batch_end_callback):
+        """Events sharing a timestamp are replayed as one batch."""
+        self.batch_begin_callback = batch_begin_callback
+        self.batch_end_callback = batch_end_callback
+
+    def dispatch(self, event_type, args):
+        if self.latency is not None:
+            self.latency.begin(event_type)
+        self.callbacks[event_type](*args)
+
+    def run(self):
+        start = time.monotonic()
+        batch_time = None
+        for index, (timestamp, event_type, args) in enumerate(self.events):
+            if self.batch_begin_callback and timestamp != batch_time:
+                if batch_time is not None:
+                    self.batch_end_callback()
+                self.batch_begin_callback()
+                batch_time = timestamp
+            if self.realtime:
+                delay = start + timestamp - time.monotonic()
+                if delay > 0: time.sleep(delay)
+            if self.event_hook:
+                self.event_hook(index)
+            self.dispatch(event_type, args)
+        if batch_time is not None:
+            self.batch_end_callback()
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+def run_benchmark(events, num_clients, realtime=False, switch_every=0, broadcast=False,
+                  batch=False, record=None, show_metrics=False):
+    replay = ReplayInput(events, realtime)
+    hub_transport = transport.LoopbackTransport("bthub-bench-%d" % os.getpid())
+    recorder = recording.Recorder(record) if record else None
+    hub = forwarder.Forwarder(sys.path[0], input_device=replay, hid_transport=hub_transport,
+                              register_profile=False, track_latency=True, remember_hosts=False,
+                              broadcast_addresses=[] if broadcast else None, batch=batch,
+                              recorder=recorder)
+    hub.start_accepting()
+    hosts = [fake_host.FakeHost(hub_transport, "00:00:00:00:00:%02x" % (i + 1))
+             for i in range(num_clients)]
+    if not wait_for(lambda: len(hub.clients) == num_clients, 5):
+        raise RuntimeError("Only %d of %d hosts connected" % (len(hub.clients), num_clients))
+
+    if switch_every:
+        def switch(index):
+            if index and index % switch_every == 0:
+                hub.switch_client()
+        replay.event_hook = switch
+
+    start_time = time.monotonic()
+    start_cpu = time.process_time()
+    replay.run()
+    hub.client.mouse.flush_motion()
+
+    sent = lambda: sum(client.get_stats()["sent"] for client in hub.clients.values())
+    drained = lambda: (all(client.get_stats()["queue_depth"] == 0
+                           for client in hub.clients.values())
+                       and sum(host.reports for host in hosts) >= sent())
+    if not wait_for(drained, 10):
+        logger.warning("Hosts did not receive every report")
+    elapsed = time.monotonic() - start_time
+    cpu = time.process_time() - start_cpu
+
+    reports = sum(host.reports for host in hosts)
+    dropped = sum(client.get_stats()["dropped"] for client in hub.clients.values())
+    print("clients:        %d" % num_clients)
+    print("events:         %d" % len(events))
+    print("reports:        %d (%d dropped)" % (reports, dropped))
+    print("bytes:          %d" % sum(host.bytes for host in hosts))
+    print("elapsed:        %.3fs" % elapsed)
+    print("events/sec:     %.0f" % (len(events) / elapsed))
+    print("reports/sec:    %.0f" % (reports / elapsed))
+    print("cpu per event:  %.1fus" % (cpu / max(len(events), 1) * 1e6))
+    for line in hub.latency.summary():
+        if line.startswith(latency.STAGE_SENT):
+            print("latency %s" % line)
+    if show_metrics:
+        sys.stdout.write(hub.metrics.render())
+    for host in hosts:
+        host.close()
+    if recorder is not None:
+        recorder.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1, help="number of fake hosts")
+    parser.add_argument("--stream", help="recorded input stream to replay")
+    parser.add_argument("--synthetic", choices=("typing", "motion", "mixed"), default="mixed",
+                        help="kind of generated stream when --stream is not given")
+    parser.add_argument("--events", type=int, default=10000,
+                        help="number of generated events")
+    parser.add_argument("--realtime", action="store_true",
+                        help="replay at recorded speed instead of as fast as possible")
+    parser.add_argument("--switch-every", type=int, default=0, metavar="N",
+                        help="switch to the next host every N events")
+    parser.add_argument("--broadcast", action="store_true",
+                        help="mirror every event to all hosts")
+    parser.add_argument("--batch", action="store_true",
+                        help="flush reports once per batch of events sharing a timestamp")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record the replayed events and the reports to FILE, "
+                        "for recording.py diff")
+    parser.add_argument("--metrics", action="store_true",
+                        help="print the metrics of the hub after the run")
+    args = parser.parse_args()
+    if args.stream:
+        events = load_stream(args.stream)
+    else:
+        events = synthetic_stream(args.synthetic, args.events)
+    run_benchmark(events, args.clients, args.realtime, args.switch_every, args.broadcast,
+                  args.batch, args.record, args.metrics)
@@ -2,6 +2,7 @@
 
 import threading
 import bt_hid
+import macro
 import logging
 import os
 import sys
@@ -38,6 +39,8 @@ class App(object):
 
     def console_handler(self):
         client = self.hid_device.accept()
+        player = None
+        gap = macro.DEFAULT_GAP
         while True:
             user_input = input("bt > ")
             if ' ' in user_input:
@@ -54,6 +57,22 @@ class App(object):
                 if cmd == 'close':
                     client.close()
                     client = None
+                if cmd == 'type':
+                    if args is None:
+                        logger.error("Arg missing")
+                        continue
+                    if client is None:
+                        logger.error("Not connected")
+                        continue
+                    if player is None or player.hid_client is not client:
+                        if player is not None:
+                            player.close()
+                        player = macro.MacroPlayer(client, gap)
+                    player.type(args)
+                if cmd == 'gap':
+                    gap = float(args) / 1000
+                    if player is not None:
+                        player.gap = gap
                 if cmd == 'key':
                     if args is None:
                         logger.error("Arg missing")
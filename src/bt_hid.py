@@ -1,12 +1,20 @@
 import bt_profile
 import logging
-import bluetooth
 import os
 import dbus
+import select
+import socket
 import threading
 import time
+import collections
+import heapq
 import bt_keyboard
 import bt_mouse
+import hid_descriptor
+import latency
+import transport
+from hid_descriptor import HIDP_DATA, REPORT_TYPE_INPUT, REPORT_TYPE_OUTPUT, REPORT_TYPE_FEATURE
+from gi.repository import GLib
 
 PORT_CONTROL = 17
 PORT_INTERRUPT = 19
@@ -19,6 +27,115 @@ SDP_RECORD_FILENAME = "sdp_record.xml"
 # See https://www.bluetooth.com/specifications/assigned-numbers/service-discovery/
 HID_SERVICE_UUID = "00001124-0000-1000-8000-00805f9b34fb"
 
+BLUEZ_SERVICE = "org.bluez"
+ADAPTER_INTERFACE = "org.bluez.Adapter1"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+
+# Max number of reports waiting for a host before stale motion is dropped.
+DEFAULT_QUEUE_DEPTH = 32
+
+# A host with this many transitions queued, about 8s of reports, has stopped
+# reading. Its client is closed rather than replaying old keystrokes later.
+MAX_QUEUE_DEPTH = 1024
+
+# Hosts connecting at the same time may queue this many channels per port.
+ACCEPT_BACKLOG = 8
+
+# Seconds an accepted channel waits for the other channel of its host.
+PAIRING_TIMEOUT = 5.0
+
+CHANNEL_NAMES = ("control", "interrupt")
+
+# Size of the buffer every receiver reads messages into.
+RECV_SIZE = 4096
+
+# HIDP message types (high nibble) and parameters, DATA and the report
+# types are in hid_descriptor.
+HIDP_HANDSHAKE = 0x00
+HIDP_HID_CONTROL = 0x10
+HIDP_GET_REPORT = 0x40
+HIDP_SET_REPORT = 0x50
+HIDP_GET_PROTOCOL = 0x60
+HIDP_SET_PROTOCOL = 0x70
+HIDP_GET_IDLE = 0x80
+HIDP_SET_IDLE = 0x90
+HANDSHAKE_SUCCESSFUL = 0x00
+HANDSHAKE_ERR_INVALID_REPORT_ID = 0x02
+HANDSHAKE_ERR_UNSUPPORTED_REQUEST = 0x03
+HANDSHAKE_ERR_INVALID_PARAMETER = 0x04
+CONTROL_HARD_RESET = 0x01
+CONTROL_SOFT_RESET = 0x02
+CONTROL_SUSPEND = 0x03
+CONTROL_EXIT_SUSPEND = 0x04
+CONTROL_VIRTUAL_CABLE_UNPLUG = 0x05
+# GET_REPORT carries the max size of the reply.
+GET_REPORT_SIZE = 0x08
+
+class Timer(object):
+    __slots__ = ("when", "callback", "cancelled")
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerThread(object):
+    """Runs the timers of the threaded mode from one long-lived thread.
+    Mouse motion is flushed by a timer every poll interval, a thread per
+    timer would start hundreds of threads a second.
+
+    Cancelled timers stay queued until they are due, then are dropped."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.timers = []
+        self.thread = None
+
+    def call_later(self, delay, callback):
+        timer = Timer(time.monotonic() + delay, callback)
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.worker, name="timers")
+                self.thread.daemon = True
+                self.thread.start()
+            heapq.heappush(self.timers, timer)
+            if self.timers[0] is timer:
+                self.cond.notify()
+        return timer
+
+    def worker(self):
+        timers = self.timers
+        while True:
+            with self.cond:
+                while True:
+                    if timers and timers[0].cancelled:
+                        heapq.heappop(timers)
+                        continue
+                    now = time.monotonic()
+                    if timers and timers[0].when <= now:
+                        timer = heapq.heappop(timers)
+                        break
+                    self.cond.wait(timers[0].when - now if timers else None)
+            try:
+                timer.callback()
+            except Exception:
+                logger.exception("Timer callback failed")
+
+timer_thread = TimerThread()
+
+def start_timer(engine, delay, callback):
+    """Run callback after delay seconds, on the engine loop if there is one,
+    on timer_thread otherwise. Returns an object with cancel()."""
+    if engine is not None:
+        return engine.call_later(delay, callback)
+    return timer_thread.call_later(delay, callback)
+
 class Receiver(object):
     def __init__(self, hid_client, client_sock, close_callback=None):
         self.hid_client = hid_client
@@ -26,31 +143,298 @@ class Receiver(object):
         self.thread = threading.Thread(target=self.worker)
         self.thread.daemon = True
         self.close_callback = close_callback
+        # Messages are read into the same buffer and handed to the handler
+        # as a view, which is only valid until the next read. Sockets
+        # without recv_into (e.g. PyBluez) fall back to recv.
+        if hasattr(client_sock, "recv_into"):
+            self.buffer = bytearray(RECV_SIZE)
+            self.view = memoryview(self.buffer)
+        else:
+            self.buffer = None
 
     def start(self):
         logger.info("Starting receiver")
         self.thread.start()
 
+    def read(self):
+        """Read one message, empty when the channel is closed."""
+        if self.buffer is None:
+            return self.client.recv(RECV_SIZE)
+        return self.view[:self.client.recv_into(self.buffer)]
+
     def worker(self):
         while True:
             try:
-                msg = self.client.recv(4096)
+                msg = self.read()
                 if not msg: break
-            except bluetooth.btcommon.BluetoothError:
+            except OSError:
                 logger.info("Read error, connection broken")
                 break
-            msg_type = msg[0]
-            self.handler(msg_type, msg[1:])
+            self.dispatch(msg)
         logger.info("Stopping receiver")
         if self.close_callback:
             self.close_callback()
 
+    def dispatch(self, msg):
+        msg_type = msg[0]
+        self.handler(msg_type, msg[1:])
+
     def close(self):
         self.client.close()
 
+class Sender(object):
+    """Drains the outbound report queue of one client on its own thread, so a
+    stalled host can not block input processing.
+
+    When the queue is full, the oldest droppable (motion only) report is
+    discarded. Key and button transitions are never dropped, the client is
+    closed once MAX_QUEUE_DEPTH of them are queued."""
+
+    def __init__(self, client_sock, max_depth=DEFAULT_QUEUE_DEPTH, close_callback=None,
+                 sent_callback=None, first_sent_callback=None):
+        self.client = client_sock
+        self.max_depth = max_depth
+        self.close_callback = close_callback
+        self.sent_callback = sent_callback
+        self.first_sent_callback = first_sent_callback
+        self.queue = collections.deque()
+        lock = threading.Lock()
+        self.cond = threading.Condition(lock)
+        # Notified when a report left the queue, see wait_below().
+        self.drained = threading.Condition(lock)
+        self.running = False
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.errors = 0
+        self.peak_depth = 0
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+
+    def start(self):
+        logger.info("Starting sender")
+        self.running = True
+        self.thread.start()
+
+    def put(self, message, droppable=False, trace=None):
+        with self.cond:
+            if not self.running:
+                return False
+            if len(self.queue) >= self.max_depth and not self.drop_stale():
+                if droppable:
+                    self.dropped += 1
+                    return False
+                # Transitions are never dropped, the queue grows instead, up
+                # to MAX_QUEUE_DEPTH past which the host is taken as stalled.
+            if len(self.queue) < MAX_QUEUE_DEPTH:
+                self.queue.append((message, droppable, trace))
+                self.peak_depth = max(self.peak_depth, len(self.queue))
+                self.cond.notify()
+                return True
+            self.running = False
+            self.queue.clear()
+            self.errors += 1
+            self.cond.notify()
+            self.drained.notify_all()
+        logger.warning("Host stopped reading, %d reports queued", MAX_QUEUE_DEPTH)
+        # Wakes up the worker if it is blocked writing to the host.
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self.close_callback:
+            self.close_callback()
+        return False
+
+    def drop_stale(self):
+        for index, (message, droppable, trace) in enumerate(self.queue):
+            if droppable:
+                del self.queue[index]
+                self.dropped += 1
+                return True
+        return False
+
+    def depth(self):
+        return len(self.queue)
+
+    def wait_below(self, depth):
+        """Block until fewer than depth reports are queued, or the sender
+        stopped."""
+        with self.cond:
+            while self.running and len(self.queue) >= depth:
+                self.drained.wait()
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.running: break
+                message, droppable, trace = self.queue.popleft()
+                self.drained.notify_all()
+            try:
+                self.client.send(message)
+            except OSError:
+                logger.info("Write error, connection broken")
+                self.errors += 1
+                break
+            self.sent += 1
+            self.sent_bytes += len(message)
+            if trace is not None and self.sent_callback:
+                self.sent_callback(trace)
+            if self.sent == 1 and self.first_sent_callback:
+                self.first_sent_callback()
+        logger.info("Stopping sender")
+        with self.cond:
+            broken = self.running
+            self.running = False
+            self.queue.clear()
+            self.drained.notify_all()
+        if broken and self.close_callback:
+            self.close_callback()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+            self.drained.notify_all()
+
+class ChannelPairer(object):
+    """Pairs the control and interrupt channels of each host by remote
+    address, whatever order they are accepted in. A channel whose peer does
+    not show up within the timeout is closed."""
+
+    def __init__(self, timeout=PAIRING_TIMEOUT):
+        self.timeout = timeout
+        # remote address -> [control, interrupt, deadline]
+        self.pending = {}
+
+    def add(self, index, client_sock, remote_address):
+        """Add the channel accepted on CHANNEL_NAMES[index]. Returns the
+        (control, interrupt) pair once both are there, None otherwise."""
+        logger.info("Got %s client: %r", CHANNEL_NAMES[index], remote_address)
+        entry = self.pending.get(remote_address)
+        if entry is None:
+            entry = self.pending[remote_address] = [None, None, 0.0]
+        elif entry[index] is not None:
+            logger.warning("Replacing stale %s channel from %s",
+                           CHANNEL_NAMES[index], remote_address)
+            entry[index].close()
+        entry[index] = client_sock
+        entry[2] = time.monotonic() + self.timeout
+        if entry[0] is None or entry[1] is None:
+            return None
+        del self.pending[remote_address]
+        return entry[0], entry[1]
+
+    def expire(self):
+        """Close half-open pairs past their deadline. Returns the seconds
+        until the next deadline, or None if nothing is pending."""
+        now = time.monotonic()
+        next_deadline = None
+        for remote_address, entry in list(self.pending.items()):
+            if entry[2] <= now:
+                logger.warning("No peer channel from %s, closing", remote_address)
+                for client_sock in entry[:2]:
+                    if client_sock is not None:
+                        client_sock.close()
+                del self.pending[remote_address]
+            elif next_deadline is None or entry[2] < next_deadline:
+                next_deadline = entry[2]
+        return None if next_deadline is None else next_deadline - now
+
+class ProfileChannels(object):
+    """Channels handed over by BlueZ through the profile's NewConnection.
+
+    They arrive on the GLib thread and are queued for whoever pairs channels,
+    which polls fileno() to learn about them."""
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def put(self, client_sock, remote_address):
+        self.queue.append((client_sock, remote_address))
+        self.writer.send(b"\0")
+
+    def get_all(self):
+        try:
+            while self.reader.recv(64): pass
+        except BlockingIOError:
+            pass
+        channels = []
+        while self.queue:
+            channels.append(self.queue.popleft())
+        return channels
+
 class ControlReceiver(Receiver):
+    """Answers HIDP requests on the control channel. Every request except
+    HID_CONTROL gets its DATA or HANDSHAKE reply before the next one is read."""
+
     def handler(self, msg_type, data):
-        logger.info("Got control msg %x %s", msg_type, data)
+        request = msg_type & 0xf0
+        param = msg_type & 0x0f
+        if request == HIDP_GET_REPORT:
+            self.get_report(param, data)
+        elif request == HIDP_SET_REPORT:
+            self.handshake(self.hid_client.set_report(param & 0x03, data))
+        elif request == HIDP_GET_PROTOCOL:
+            self.reply(HIDP_DATA, self.hid_client.protocol)
+        elif request == HIDP_SET_PROTOCOL:
+            if param > bt_keyboard.PROTOCOL_REPORT:
+                self.handshake(HANDSHAKE_ERR_INVALID_PARAMETER)
+                return
+            self.hid_client.set_protocol(param)
+            self.handshake(HANDSHAKE_SUCCESSFUL)
+        elif request == HIDP_GET_IDLE:
+            self.reply(HIDP_DATA, self.hid_client.idle_rate)
+        elif request == HIDP_SET_IDLE:
+            if not data:
+                self.handshake(HANDSHAKE_ERR_INVALID_PARAMETER)
+                return
+            self.hid_client.idle_rate = data[0]
+            self.handshake(HANDSHAKE_SUCCESSFUL)
+        elif request == HIDP_HID_CONTROL:
+            # No reply, some operations close the connection.
+            self.hid_client.hid_control(param)
+        else:
+            logger.info("Unsupported control msg %x %s", msg_type, bytes(data))
+            self.handshake(HANDSHAKE_ERR_UNSUPPORTED_REQUEST)
+
+    def get_report(self, param, data):
+        if not data:
+            self.handshake(HANDSHAKE_ERR_INVALID_PARAMETER)
+            return
+        report = self.hid_client.get_report(param & 0x03, data[0])
+        if report is None:
+            self.handshake(HANDSHAKE_ERR_INVALID_REPORT_ID)
+            return
+        if param & GET_REPORT_SIZE:
+            if len(data) < 3:
+                self.handshake(HANDSHAKE_ERR_INVALID_PARAMETER)
+                return
+            # The size covers the report, not the DATA header.
+            report = report[:1 + (data[1] | data[2] << 8)]
+        self.send(report)
+
+    def handshake(self, result):
+        self.reply(HIDP_HANDSHAKE | result)
+
+    def reply(self, *message):
+        self.send(bytes(message))
+
+    def send(self, message):
+        # The engine makes the socket non-blocking, its sender queues what
+        # does not fit until the socket is writable.
+        sender = self.hid_client.control_client_sender
+        if sender is not None:
+            sender.put(message)
+        else:
+            self.client.send(message)
 
 class InterruptReceiver(Receiver):
     def handler(self, msg_type, data):
@@ -62,40 +446,89 @@ class InterruptReceiver(Receiver):
                 # Report ID 0x01: keyboard
                 self.hid_client.keyboard.led(data[1])
             else:
-                logger.info("Output: %s", data)
+                logger.info("Output: %s", bytes(data))
         else:
-            logger.info("Got interrupt msg %x %s", msg_type, data)
+            logger.info("Got interrupt msg %x %s", msg_type, bytes(data))
 
 
 class BluetoothHID(object):
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, engine=None, latency=None, hid_transport=None, nkro=False,
+                 hosts=None, profile_channels=False, timeline=None):
         logger.info("HID init")
+        self.nkro = nkro
+        # A latency.Timeline marked with the startup milestones reached here.
+        self.timeline = timeline
+        # Known hosts, a HostRegistry, or None to not remember any.
+        self.hosts = hosts
+        self.engine = engine
+        self.latency = latency
+        if hid_transport is None:
+            hid_transport = transport.L2CAPTransport()
+        self.transport = hid_transport
         self.control_sock = None
         self.interrupt_sock = None
-        self.control_client = None
-        self.interrupt_client = None
+        self.pairer = ChannelPairer()
         self.data_dir = data_dir
         self.registered = False
-        self.register_thread = None
         self.service_record = None
+        self.profile = None
+        # With profile_channels, BlueZ accepts the control channel for the
+        # profile and hands it over, only the interrupt channel is accepted
+        # here.
+        self.profile_channels = ProfileChannels() if profile_channels else None
 
     def init(self):
-        self.init_profile()
+        """Export the profile and keep it registered. Everything after this
+        is driven by D-Bus signals on the GLib main loop."""
         self.service_record = self.get_service_record()
-        self.register_thread = threading.Thread(target=self.register_worker)
-        self.register_thread.daemon = True
-        self.register_thread.start()
+        self.init_profile()
+        bus = dbus.SystemBus()
+        # Also called right away with the current owner, which registers the
+        # profile if bluetoothd is already running.
+        bus.watch_name_owner(BLUEZ_SERVICE, self.bluez_owner_changed)
+        bus.add_signal_receiver(self.properties_changed, signal_name="PropertiesChanged",
+                                dbus_interface=PROPERTIES_INTERFACE, bus_name=BLUEZ_SERVICE,
+                                arg0=ADAPTER_INTERFACE, path_keyword="path")
 
     def get_service_record(self):
-        return open(os.path.join(self.data_dir, SDP_RECORD_FILENAME)).read()
+        # The record file is a template: the report descriptor in it is
+        # replaced by the one generated from hid_descriptor.DESCRIPTOR.
+        hid_descriptor.validate()
+        with open(os.path.join(self.data_dir, SDP_RECORD_FILENAME)) as f:
+            return hid_descriptor.service_record(f.read())
 
     def init_profile(self):
         logger.info("Init HID profile")
         bus = dbus.SystemBus()
-        profile = bt_profile.BluetoothHIDProfile(bus, HID_PROFILE_PATH, self.release_cb)
+        connection_callback = None
+        if self.profile_channels is not None:
+            connection_callback = self.profile_channels.put
+        self.profile = bt_profile.BluetoothHIDProfile(bus, HID_PROFILE_PATH, self.release_cb,
+                                                      connection_callback)
 
     def release_cb(self):
         self.registered = False
+        # Not from within the Release call, bluetoothd is waiting for it.
+        GLib.idle_add(self.ensure_registered)
+
+    def bluez_owner_changed(self, owner):
+        self.registered = False
+        if owner:
+            logger.info("bluetoothd is running as %s", owner)
+            self.ensure_registered()
+        else:
+            logger.warning("bluetoothd is gone")
+
+    def properties_changed(self, interface, changed, invalidated, path=None):
+        if changed.get("Powered"):
+            logger.info("Adapter %s powered on", path)
+            self.ensure_registered()
+
+    def ensure_registered(self):
+        if not self.registered:
+            self.registered = self.register_profile()
+        # Also used as a one-shot GLib source.
+        return False
 
     def register_profile(self):
         """Register a profile to bluez.
@@ -109,69 +542,160 @@ class BluetoothHID(object):
                 "RequiredAuthentication": True,
                 "RequiredAuthorization": True,
             }
+            if self.profile_channels is not None:
+                options["PSM"] = dbus.UInt16(PORT_CONTROL)
             bus = dbus.SystemBus()
             bluez = bus.get_object("org.bluez", "/org/bluez")
             profile_manager = dbus.Interface(bluez, "org.bluez.ProfileManager1")
             profile_manager.RegisterProfile(HID_PROFILE_PATH, HID_SERVICE_UUID, options)
             logger.info("Registered profile to bluez")
+            self.profile_registered()
             return True
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() == "org.bluez.Error.AlreadyExists":
+                self.profile_registered()
+                return True
+            # Retried on the next signal from bluetoothd.
+            logger.error("Fail to register profile: %s", e)
+            return False
         except Exception as e:
             logger.exception("Fail to register profile: %s", e)
             return False
 
-    def register_worker(self):
-        while True:
-            if not self.registered:
-                if self.register_profile():
-                    self.registered = True
-            time.sleep(1)
+    def profile_registered(self):
+        if self.timeline is not None:
+            self.timeline.mark(latency.MILESTONE_PROFILE_REGISTERED)
 
     def listen(self):
         logger.info("Listening for connections")
-        self.control_sock = bluetooth.BluetoothSocket(proto=bluetooth.L2CAP)
-        self.control_sock.bind(("", PORT_CONTROL))
-        self.control_sock.listen(1)
-
-        self.interrupt_sock = bluetooth.BluetoothSocket(proto=bluetooth.L2CAP)
-        self.interrupt_sock.bind(("", PORT_INTERRUPT))
-        self.interrupt_sock.listen(1)
+        if self.profile_channels is None:
+            self.control_sock = self.transport.listen(PORT_CONTROL, ACCEPT_BACKLOG)
+        self.interrupt_sock = self.transport.listen(PORT_INTERRUPT, ACCEPT_BACKLOG)
 
     def accept(self, close_callback=None):
+        """Wait on both listening sockets until some host has opened both of
+        its channels, and return its client."""
         logger.info("Accepting for connections")
-
-        if self.control_client is not None:
-            logger.error("Already accepted")
-            return
-
-        control_client, control_client_info = self.control_sock.accept()
-        logger.info("Got control client: %r", control_client_info[0])
-
-        interrupt_client, interrupt_client_info = self.interrupt_sock.accept()
-        logger.info("Got interrupt client: %r", interrupt_client_info[0])
-
-        return BluetoothHIDClient(control_client, interrupt_client,
-                                  control_client_info[0], close_callback)
+        listeners = {}
+        for index, sock in enumerate((self.control_sock, self.interrupt_sock)):
+            if sock is not None:
+                listeners[sock.fileno()] = (index, sock)
+        if self.profile_channels is not None:
+            listeners[self.profile_channels.fileno()] = (0, None)
+        poller = select.poll()
+        for fd in listeners:
+            poller.register(fd, select.POLLIN)
+        while True:
+            timeout = self.pairer.expire()
+            ready = poller.poll(None if timeout is None else int(timeout * 1000) + 1)
+            for fd, event in ready:
+                index, sock = listeners[fd]
+                if sock is None:
+                    accepted = self.profile_channels.get_all()
+                else:
+                    try:
+                        accepted = [self.transport.accept(sock)]
+                    except OSError as e:
+                        logger.error("Accept failed: %s", e)
+                        continue
+                for client_sock, remote_address in accepted:
+                    channels = self.pairer.add(index, client_sock, remote_address)
+                    if channels is not None:
+                        return self.create_client(channels[0], channels[1],
+                                                  remote_address, close_callback)
+
+    def connect(self, remote_address):
+        """Open both channels to a host, control first. Returns the
+        (control, interrupt) pair, raises OSError if the host is not there."""
+        logger.info("Connecting to %s", remote_address)
+        control_client = self.transport.connect(remote_address, PORT_CONTROL)
+        try:
+            interrupt_client = self.transport.connect(remote_address, PORT_INTERRUPT)
+        except OSError:
+            control_client.close()
+            raise
+        return control_client, interrupt_client
+
+    def create_client(self, control_client, interrupt_client, remote_address,
+                      close_callback=None):
+        if self.profile is not None:
+            close_callback = self.forget_profile_channel(control_client, close_callback)
+        client = BluetoothHIDClient(control_client, interrupt_client,
+                                    remote_address, close_callback, self.engine,
+                                    self.latency, self.nkro, self.hosts, self.timeline)
+        if self.hosts is not None:
+            self.hosts.add(remote_address, client.protocol)
+        return client
+
+    def forget_profile_channel(self, sock, close_callback):
+        """close_callback, also dropping sock from the profile if it handed
+        it over."""
+        def client_closed(remote_address):
+            self.profile.forget(sock)
+            if close_callback:
+                close_callback(remote_address)
+        return client_closed
+
+    def create_broadcast_group(self, clients):
+        return BroadcastGroup(clients, self.engine, self.latency)
 
 class BluetoothHIDClient(object):
-    def __init__(self, control_client, interrupt_client, remote_address, close_callback):
+    def __init__(self, control_client, interrupt_client, remote_address, close_callback,
+                 engine=None, latency=None, nkro=False, hosts=None, timeline=None):
         self.control_client = control_client
         self.interrupt_client = interrupt_client
         self.remote_address = remote_address
         self.close_callback = close_callback
+        self.engine = engine
+        self.latency = latency
+        self.hosts = hosts
+        self.timeline = timeline
+        self.closed = False
+        # Set by the host with HID_CONTROL, idle links are left alone then.
+        self.suspended = False
+        # Deprecated by HIDP 1.1, only kept to answer GET_IDLE.
+        self.idle_rate = 0
+        # Called with the address and every report before it is queued.
+        self.report_callback = None
+        # Called with the client when the host changes the report format,
+        # see BroadcastGroup.
+        self.mode_callback = None
+        # Trace started when input was switched to this client, handed to the
+        # next report so the time to the first report is measured.
+        self.switch_trace = None
+
+        self.protocol = bt_keyboard.PROTOCOL_REPORT
+        self.keyboard = bt_keyboard.BluetoothKeyboard(self, nkro)
+        self.mouse = bt_mouse.BluetoothMouse(self)
 
+        # Only with the engine, replies are written directly otherwise.
+        self.control_client_sender = None
         self.control_client_receiver = ControlReceiver(self, self.control_client,
                                                        self.client_closed)
-        self.control_client_receiver.start()
         self.interrupt_client_receiver = InterruptReceiver(self, self.interrupt_client)
-        self.interrupt_client_receiver.start()
-
-        self.keyboard = bt_keyboard.BluetoothKeyboard(self)
-        self.mouse = bt_mouse.BluetoothMouse(self)
+        if engine is None:
+            # The sender goes first, a receiver may close the client at once.
+            self.interrupt_client_sender = Sender(self.interrupt_client,
+                                                  close_callback=self.client_closed,
+                                                  sent_callback=self.report_sent,
+                                                  first_sent_callback=self.first_sent())
+            self.interrupt_client_sender.start()
+            self.control_client_receiver.start()
+            self.interrupt_client_receiver.start()
+        else:
+            # The engine reads both channels and writes reports from its loop.
+            self.interrupt_client_sender = engine.attach_client(self)
+            self.control_client_sender = engine.create_sender(self.control_client,
+                                                              self.client_closed)
 
     def get_remote_address(self):
         return self.remote_address
 
     def close(self):
+        if self.closed: return
+        self.closed = True
+        if self.engine is not None and self.control_client:
+            self.engine.detach_client(self)
         if self.control_client:
             self.control_client.close()
             self.control_client = None
@@ -179,6 +703,8 @@ class BluetoothHIDClient(object):
             self.control_client_receiver = None
 
         if self.interrupt_client:
+            logger.info("Closing %s: %r", self.remote_address, self.get_stats())
+            self.interrupt_client_sender.close()
             self.interrupt_client.close()
             self.interrupt_client = None
             self.interrupt_client_receiver.close()
@@ -189,10 +715,262 @@ class BluetoothHIDClient(object):
     def client_closed(self):
         self.close()
 
-    def send_interrupt_message(self, message):
+    def call_later(self, delay, callback):
+        return start_timer(self.engine, delay, callback)
+
+    def set_protocol(self, protocol):
+        logger.info("%s switched to %s protocol", self.remote_address,
+                    "report" if protocol == bt_keyboard.PROTOCOL_REPORT else "boot")
+        self.protocol = protocol
+        self.mouse.set_protocol(protocol)
+        self.keyboard.set_protocol(protocol)
+        if self.hosts is not None:
+            self.hosts.set_protocol(self.remote_address, protocol)
+        if self.mode_callback is not None:
+            self.mode_callback(self)
+
+    def begin_switch(self):
+        if self.latency is not None:
+            self.switch_trace = self.latency.start("switch")
+
+    def keep_alive(self):
+        """Send a report that changes nothing on the host, so the link does
+        not enter sniff mode while the client is idle."""
+        if self.interrupt_client and not self.suspended:
+            self.interrupt_client_sender.put(self.mouse.button_report(), True)
+
+    def get_report(self, report_type, report_id):
+        """The report asked for by GET_REPORT, with its DATA header, or None
+        if there is no such report."""
+        if report_type == REPORT_TYPE_INPUT:
+            return (self.keyboard.get_input_report(report_id) or
+                    self.mouse.get_input_report(report_id))
+        if report_type == REPORT_TYPE_OUTPUT and report_id == bt_keyboard.KEYBOARD_REPORT_ID:
+            return hid_descriptor.LEDS.pack(self.keyboard.leds)
+        if report_type == REPORT_TYPE_FEATURE and report_id == bt_mouse.RESOLUTION_REPORT_ID:
+            return hid_descriptor.RESOLUTION.pack(self.mouse.get_resolution_multiplier())
+        return None
+
+    def set_report(self, report_type, data):
+        """Apply a SET_REPORT, returns the HANDSHAKE result."""
+        if len(data) < 2:
+            return HANDSHAKE_ERR_INVALID_PARAMETER
+        if report_type == REPORT_TYPE_OUTPUT and data[0] == bt_keyboard.KEYBOARD_REPORT_ID:
+            self.keyboard.led(data[1])
+            return HANDSHAKE_SUCCESSFUL
+        if report_type == REPORT_TYPE_FEATURE and data[0] == bt_mouse.RESOLUTION_REPORT_ID:
+            self.mouse.set_resolution_multiplier(data[1])
+            if self.mode_callback is not None:
+                self.mode_callback(self)
+            return HANDSHAKE_SUCCESSFUL
+        if report_type == REPORT_TYPE_INPUT:
+            return HANDSHAKE_ERR_UNSUPPORTED_REQUEST
+        return HANDSHAKE_ERR_INVALID_REPORT_ID
+
+    def hid_control(self, operation):
+        if operation in (CONTROL_HARD_RESET, CONTROL_SOFT_RESET):
+            logger.info("%s reset the device", self.remote_address)
+            self.keyboard.clear()
+            self.mouse.clear()
+        elif operation == CONTROL_SUSPEND:
+            logger.info("%s suspended", self.remote_address)
+            self.suspended = True
+        elif operation == CONTROL_EXIT_SUSPEND:
+            logger.info("%s resumed", self.remote_address)
+            self.suspended = False
+        elif operation == CONTROL_VIRTUAL_CABLE_UNPLUG:
+            logger.info("%s unplugged the virtual cable", self.remote_address)
+            if self.hosts is not None:
+                self.hosts.remove(self.remote_address)
+            self.close()
+        else:
+            logger.info("Unknown HID_CONTROL operation %x", operation)
+
+    def queue_depth(self):
+        return self.interrupt_client_sender.depth()
+
+    def wait_for_queue(self, depth):
+        """Block until fewer than depth reports are queued for the host."""
+        self.interrupt_client_sender.wait_below(depth)
+
+    def get_stats(self):
+        sender = self.interrupt_client_sender
+        return {
+            "queue_depth": sender.depth(),
+            "peak_queue_depth": sender.peak_depth,
+            "sent": sender.sent,
+            "sent_bytes": sender.sent_bytes,
+            "dropped": sender.dropped,
+            "errors": sender.errors,
+        }
+
+    def get_threads(self):
+        """Thread name -> whether it is alive. Empty with an engine, which
+        serves the client from its loop."""
+        if self.engine is not None:
+            return {}
+        threads = {"sender": self.interrupt_client_sender.thread}
+        if self.control_client_receiver is not None:
+            threads["control"] = self.control_client_receiver.thread
+        if self.interrupt_client_receiver is not None:
+            threads["interrupt"] = self.interrupt_client_receiver.thread
+        return {name: thread.is_alive() for name, thread in threads.items()}
+
+    def send_interrupt_message(self, message, droppable=False):
+        """Queue a report for the interrupt channel. Set droppable for reports
+        that only carry motion and may be discarded when the host is slow."""
         if not self.interrupt_client:
             logger.error("Client closed")
             return
 
-        logger.debug("Sending %r", message)
-        self.interrupt_client.send(message)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending %r", message)
+        if self.report_callback is not None:
+            self.report_callback(self.remote_address, message)
+        trace = None
+        if self.latency is not None:
+            trace = self.switch_trace or self.latency.capture()
+            self.switch_trace = None
+            self.latency.mark(latency.STAGE_REPORT, self.remote_address, trace)
+        self.interrupt_client_sender.put(message, droppable, trace)
+
+    def report_sent(self, trace):
+        self.latency.finish(trace, self.remote_address)
+
+    def first_sent(self):
+        """Callback for the sender's first report, None if not needed."""
+        if self.timeline is None:
+            return None
+        return lambda: self.timeline.mark(latency.MILESTONE_FIRST_REPORT)
+
+class FanOut(object):
+    """Stands for the keyboard or the mouse of a BroadcastGroup: a method
+    call is made on that device of every variant of the group."""
+
+    def __init__(self, group, device):
+        self.group = group
+        self.device = device
+
+    def __getattr__(self, name):
+        group = self.group
+        device = self.device
+        def call(*args):
+            for variant in group.variants:
+                getattr(getattr(variant, device), name)(*args)
+        # Looked up once, the variants are read on every call.
+        setattr(self, name, call)
+        return call
+
+class BroadcastVariant(object):
+    """Members of a BroadcastGroup that take the same reports: same
+    protocol, resolution multiplier and NKRO setting. Its keyboard and mouse
+    encode each report once for all of them."""
+
+    def __init__(self, group, key):
+        protocol, resolution, nkro = key
+        self.group = group
+        self.key = key
+        self.members = ()
+        self.protocol = protocol
+        self.keyboard = bt_keyboard.BluetoothKeyboard(self, nkro)
+        self.keyboard.set_protocol(protocol)
+        self.mouse = bt_mouse.BluetoothMouse(self)
+        self.mouse.set_protocol(protocol)
+        self.mouse.set_resolution_multiplier(resolution)
+
+    def call_later(self, delay, callback):
+        return self.group.call_later(delay, callback)
+
+    def send_interrupt_message(self, message, droppable=False):
+        members = self.members
+        if not members: return
+        group = self.group
+        if group.report_callback is not None:
+            group.report_callback(group.BROADCAST_ADDRESS, message)
+        trace = None
+        if group.latency is not None:
+            trace = group.latency.capture()
+            group.latency.mark(latency.STAGE_REPORT, group.BROADCAST_ADDRESS, trace)
+        for client in members:
+            if client.interrupt_client:
+                client.interrupt_client_sender.put(message, droppable, trace)
+
+class BroadcastGroup(object):
+    """Drives several clients at once.
+
+    Members are split in variants by the report format their host asked
+    for. Each variant has its own keyboard and mouse state, so every report
+    is encoded once per variant and then handed to the sender of each of its
+    members. Senders never block, so a slow member does not delay the
+    others."""
+
+    BROADCAST_ADDRESS = "broadcast"
+
+    def __init__(self, clients, engine=None, latency=None):
+        self.engine = engine
+        self.latency = latency
+        self.report_callback = None
+        self.lock = threading.Lock()
+        self.members = ()
+        self.variants = ()
+        self.keyboard = FanOut(self, "keyboard")
+        self.mouse = FanOut(self, "mouse")
+        for client in clients:
+            self.add(client)
+
+    def get_remote_address(self):
+        return self.BROADCAST_ADDRESS
+
+    def add(self, client):
+        with self.lock:
+            if client in self.members: return
+            # Replaced rather than mutated, so senders can iterate safely.
+            self.members = self.members + (client,)
+            client.mode_callback = self.member_changed
+            self.regroup()
+
+    def remove(self, client):
+        with self.lock:
+            self.members = tuple(member for member in self.members if member is not client)
+            if client.mode_callback == self.member_changed:
+                client.mode_callback = None
+            self.regroup()
+
+    def close(self):
+        with self.lock:
+            for client in self.members:
+                if client.mode_callback == self.member_changed:
+                    client.mode_callback = None
+
+    def member_changed(self, client):
+        """A member changed protocol or resolution multiplier."""
+        with self.lock:
+            self.regroup()
+
+    def regroup(self):
+        variants = {variant.key: variant for variant in self.variants}
+        clients = {}
+        for client in self.members:
+            key = (client.protocol, client.mouse.get_resolution_multiplier(),
+                   client.keyboard.nkro)
+            clients.setdefault(key, []).append(client)
+        regrouped = []
+        for key, members in clients.items():
+            variant = variants.get(key)
+            if variant is None:
+                variant = BroadcastVariant(self, key)
+            variant.members = tuple(members)
+            regrouped.append(variant)
+        self.variants = tuple(regrouped)
+
+    def call_later(self, delay, callback):
+        return start_timer(self.engine, delay, callback)
+
+    def queue_depth(self):
+        """Depth of the fullest queue, the slowest member sets the pace."""
+        return max((client.queue_depth() for client in self.members
+                    if client.interrupt_client), default=0)
+
+    def wait_for_queue(self, depth):
+        for client in self.members:
+            client.wait_for_queue(depth)
@@ -1,8 +1,19 @@
 import time
 import logging
+import functools
+import diagnostics
+import hid_descriptor
 
 logger = logging.getLogger(__name__)
 
+UNKNOWN_MEDIA_KEY_LOG = diagnostics.RateLimitedLog(
+    logger, logging.WARNING, "Unknown media key: %x",
+    "Unknown media keys pressed {count:,} more times in the last {seconds:.0f}s")
+ROLLOVER_LOG = diagnostics.RateLimitedLog(
+    logger, logging.WARNING, "Too many key pressed, reporting rollover for %x",
+    "Too many keys pressed {count:,} more times in the last {seconds:.0f}s, "
+    "reported rollover")
+
 def check_modifier(modifier):
     if modifier >= 8:
         logger.warn("Modifier %d out of range", modifier)
@@ -23,74 +34,188 @@ MEDIA_KEY_REPORT_POS = {
     0x30: 0x0400, # Power
 }
 
+# Boot keyboard report: 0xA1 0x01, modifiers, reserved, 6 key slots.
+KEYBOARD_REPORT_ID = hid_descriptor.KEYBOARD.report_id
+REPORT_MODIFIER_POS = 2
+REPORT_KEYS_POS = 4
+KEY_SLOTS = 6
+
+# Reported in every key slot when more than KEY_SLOTS keys are held.
+ERROR_ROLL_OVER = 0x01
+
+# N-key rollover report: 0xA1 0x04, modifiers, bitmap of usages 0x00 ~ 0xDF.
+NKRO_REPORT_ID = hid_descriptor.NKRO.report_id
+NKRO_BITMAP_POS = 3
+NKRO_MAX_KEY = 0xdf
+NKRO_REPORT_SIZE = NKRO_BITMAP_POS + (NKRO_MAX_KEY + 1) // 8
+
+# Media keys, only in report protocol: in boot protocol ID 2 is the mouse.
+MEDIA_REPORT_ID = hid_descriptor.MEDIA.report_id
+
+# HIDP protocol modes, see SET_PROTOCOL.
+PROTOCOL_BOOT = 0
+PROTOCOL_REPORT = 1
+
 def add_media_key_to_data(media_key, data):
     pos = MEDIA_KEY_REPORT_POS.get(media_key, None)
     if pos is None:
-        logger.warning("Unknown media key: %x", media_key)
+        UNKNOWN_MEDIA_KEY_LOG(media_key)
         return data
     return data | pos
 
+@functools.lru_cache(maxsize=64)
+def encode_media_report(data):
+    return hid_descriptor.MEDIA.pack(data)
+
 
 class BluetoothKeyboard(object):
-    def __init__(self, hid_device):
+    def __init__(self, hid_device, nkro=False):
         self.hid_device = hid_device
-        self.active_modifiers = set()
-        self.active_keys = set()
-        self.active_media_keys = set()
+        self.nkro = nkro
+        self.protocol = PROTOCOL_REPORT
+        # LED state set by the host, see led().
+        self.leds = 0x00
+        # Bitmap of held media keys, see MEDIA_KEY_REPORT_POS.
+        self.media_keys = 0x0000
+        # The report is kept up to date in place on every key change.
+        self.report = hid_descriptor.KEYBOARD.buffer()
+        # Key held in each report slot. A key keeps its slot until released,
+        # so the slot order does not change between reports.
+        self.slots = [0] * KEY_SLOTS
+        # Every held key in press order, including those without a slot.
+        self.pressed_keys = []
+        self.last_report = None
+        # Same state as a bitmap, which fits any number of held keys.
+        self.nkro_report = hid_descriptor.NKRO.buffer()
+        self.last_nkro_report = None
+        # While batching, reports are only sent by end_batch(), unless a key
+        # pressed in the batch is released before that.
+        self.batching = False
+        self.report_dirty = False
+        self.media_report_dirty = False
+        self.batch_pressed = set()
+
+    def use_nkro(self):
+        # Boot protocol hosts only understand the 6 key boot report.
+        return self.nkro and self.protocol == PROTOCOL_REPORT
+
+    def set_protocol(self, protocol):
+        if protocol == self.protocol: return
+        self.protocol = protocol
+        # Let the host know the current state in the new format.
+        self.send_report(force=True)
+
+    def begin_batch(self):
+        self.batching = True
+
+    def end_batch(self):
+        self.batching = False
+        self.flush_batch()
+
+    def flush_batch(self):
+        self.batch_pressed.clear()
+        if self.report_dirty:
+            self.report_dirty = False
+            self.write_report()
+        if self.media_report_dirty:
+            self.media_report_dirty = False
+            self.write_media_report()
+
+    def batch_press(self, kind, code):
+        if self.batching:
+            self.batch_pressed.add((kind, code))
+
+    def batch_release(self, kind, code):
+        # The host has to see the press before the release, or the keystroke
+        # is lost.
+        if (kind, code) in self.batch_pressed:
+            self.flush_batch()
 
     def modifier_down(self, modifier):
         if not check_modifier(modifier): return
-        self.active_modifiers.add(modifier)
+        self.batch_press("modifier", modifier)
+        self.report[REPORT_MODIFIER_POS] |= 1 << modifier
+        self.nkro_report[REPORT_MODIFIER_POS] = self.report[REPORT_MODIFIER_POS]
         self.send_report()
 
     def modifier_up(self, modifier):
         if not check_modifier(modifier): return
-        if modifier in self.active_modifiers:
-            self.active_modifiers.remove(modifier)
+        self.batch_release("modifier", modifier)
+        self.report[REPORT_MODIFIER_POS] &= ~(1 << modifier) & 0xff
+        self.nkro_report[REPORT_MODIFIER_POS] = self.report[REPORT_MODIFIER_POS]
         self.send_report()
 
     def key_down(self, key):
-        self.active_keys.add(key)
+        if key in self.pressed_keys: return
+        self.batch_press("key", key)
+        self.pressed_keys.append(key)
+        if key <= NKRO_MAX_KEY:
+            self.nkro_report[NKRO_BITMAP_POS + (key >> 3)] |= 1 << (key & 0x07)
+        if 0 in self.slots:
+            self.slots[self.slots.index(0)] = key
+        elif not self.use_nkro():
+            ROLLOVER_LOG(key)
+        self.update_key_slots()
         self.send_report()
 
     def key_up(self, key):
-        if key in self.active_keys:
-            self.active_keys.remove(key)
+        if key not in self.pressed_keys: return
+        self.batch_release("key", key)
+        self.pressed_keys.remove(key)
+        if key <= NKRO_MAX_KEY:
+            self.nkro_report[NKRO_BITMAP_POS + (key >> 3)] &= ~(1 << (key & 0x07)) & 0xff
+        if key in self.slots:
+            slot = self.slots.index(key)
+            self.slots[slot] = 0
+            # Give the free slot to the oldest key that did not have one.
+            for pressed_key in self.pressed_keys:
+                if pressed_key not in self.slots:
+                    self.slots[slot] = pressed_key
+                    break
+        self.update_key_slots()
         self.send_report()
 
+    def update_key_slots(self):
+        rollover = len(self.pressed_keys) > KEY_SLOTS
+        for slot, key in enumerate(self.slots):
+            self.report[REPORT_KEYS_POS + slot] = ERROR_ROLL_OVER if rollover else key
+
     def media_key_down(self, key):
-        self.active_media_keys.add(key)
+        self.batch_press("media", key)
+        self.media_keys = add_media_key_to_data(key, self.media_keys)
         self.send_media_report()
 
     def media_key_up(self, key):
-        if key in self.active_media_keys: self.active_media_keys.remove(key)
+        self.batch_release("media", key)
+        self.media_keys &= ~MEDIA_KEY_REPORT_POS.get(key, 0)
         self.send_media_report()
 
-    def send_report(self):
-        # 0xA1: 0xA0 = DATA 0x01 = Input
-        # 0x01: HID report ID
-        modifier_byte = 0x0
-        for modifier in self.active_modifiers:
-            modifier_byte |= 1 << modifier
-        message = bytearray([0xa1, 0x01, modifier_byte, 0x00,
-                             0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-        key_index = 5 # 5 ~ 10
-        for key in self.active_keys:
-            if key_index < len(message):
-                message[key_index] = key
-                key_index += 1
-            else:
-                logger.warn("Too many key pressed, discarding %x", key)
-        self.hid_device.send_interrupt_message(bytes(message))
+    def send_report(self, force=False):
+        if self.batching and not force:
+            self.report_dirty = True
+            return
+        self.write_report(force)
+
+    def write_report(self, force=False):
+        # Unchanged state is never sent again.
+        if self.use_nkro():
+            if not force and self.nkro_report == self.last_nkro_report: return
+            self.last_nkro_report = bytes(self.nkro_report)
+            self.hid_device.send_interrupt_message(self.last_nkro_report)
+            return
+        if not force and self.report == self.last_report: return
+        self.last_report = bytes(self.report)
+        self.hid_device.send_interrupt_message(self.last_report)
 
     def send_media_report(self):
-        # 0xA1: 0xA0 = DATA 0x01 = Input
-        # 0x02: HID report ID
-        data = 0x0000
-        for media_key in self.active_media_keys:
-            data = add_media_key_to_data(media_key, data)
-        message = bytearray([0xa1, 0x02, data & 0xff, data >> 8, 0x00])
-        self.hid_device.send_interrupt_message(bytes(message))
+        if self.batching:
+            self.media_report_dirty = True
+            return
+        self.write_media_report()
+
+    def write_media_report(self):
+        if self.protocol == PROTOCOL_BOOT: return
+        self.hid_device.send_interrupt_message(encode_media_report(self.media_keys))
 
     def key(self, modifier, key):
         if modifier is not None:
@@ -101,7 +226,21 @@ class BluetoothKeyboard(object):
         if modifier is not None:
             self.modifier_up(modifier)
 
+    def get_input_report(self, report_id):
+        """Current state as the input report report_id, or None if there
+        is no such report in the current protocol."""
+        if report_id == KEYBOARD_REPORT_ID:
+            return bytes(self.report)
+        if self.protocol == PROTOCOL_BOOT:
+            return None
+        if report_id == MEDIA_REPORT_ID:
+            return encode_media_report(self.media_keys)
+        if report_id == NKRO_REPORT_ID and self.nkro:
+            return bytes(self.nkro_report)
+        return None
+
     def led(self, led):
+        self.leds = led
         leds = []
         if led & 0x1:
             leds.append('NUM')
@@ -112,6 +251,9 @@ class BluetoothKeyboard(object):
         logger.info("LED: %s", ' '.join(leds))
 
     def clear(self):
-        self.active_keys.clear()
-        self.active_modifiers.clear()
+        self.pressed_keys = []
+        self.slots = [0] * KEY_SLOTS
+        self.report[REPORT_MODIFIER_POS] = 0
+        self.nkro_report[REPORT_MODIFIER_POS:] = bytes(NKRO_REPORT_SIZE - REPORT_MODIFIER_POS)
+        self.update_key_slots()
         self.send_report()
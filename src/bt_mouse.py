@@ -1,5 +1,9 @@
 import time
 import logging
+import threading
+import functools
+import hid_descriptor
+from bt_keyboard import PROTOCOL_BOOT, PROTOCOL_REPORT
 
 logger = logging.getLogger(__name__)
 
@@ -9,24 +13,97 @@ def check_button(button):
         return False
     return True
 
+MOUSE_REPORT_ID = hid_descriptor.MOUSE.report_id
+# Boot protocol mouse report: 0xA1 0x02, buttons 1-3, dx, dy.
+BOOT_REPORT_ID = hid_descriptor.BOOT_MOUSE.report_id
+
+# Wheel resolution when the host enabled the Resolution Multiplier feature
+# (report ID 5), must match Physical Maximum in the descriptor.
+HIRES_MULTIPLIER = 8
+RESOLUTION_REPORT_ID = hid_descriptor.RESOLUTION.report_id
+
+# Default interval between two motion reports, in seconds. Most hosts poll
+# BT HID devices at 125 Hz or less, so anything faster only fills the queue.
+DEFAULT_POLL_INTERVAL = 0.008
+
 def bound(value, minimum, maximum):
     return max(min(value, maximum), minimum)
 
+# Motion and scrolling must already be bounded to the report fields.
+encode_report = hid_descriptor.MOUSE.pack
+
+@functools.lru_cache(maxsize=64)
+def encode_button_report(buttons):
+    """Zero motion report, shared by every report with the same buttons."""
+    return encode_report(buttons, 0, 0, 0, 0)
+
+def encode_boot_report(buttons, dx, dy):
+    return hid_descriptor.BOOT_MOUSE.pack(buttons & 0x07, dx, dy)
+
+@functools.lru_cache(maxsize=8)
+def encode_boot_button_report(buttons):
+    return encode_boot_report(buttons, 0, 0)
+
 class BluetoothMouse(object):
-    def __init__(self, hid_device):
+    def __init__(self, hid_device, poll_interval=DEFAULT_POLL_INTERVAL):
         self.hid_device = hid_device
-        self.active_buttons = set()
+        self.protocol = PROTOCOL_REPORT
+        # Bitmap of held buttons.
+        self.buttons = 0x0000
+        self.poll_interval = poll_interval
+        # Motion accumulated since the last report, including the fractional
+        # part that did not fit in the previous report.
+        self.pending_dx = 0.0
+        self.pending_dy = 0.0
+        # Same for scrolling, in units of 1 / multiplier notch.
+        self.pending_dv = 0.0
+        self.pending_dh = 0.0
+        self.wheel_multiplier = 1
+        self.pan_multiplier = 1
+        self.last_motion_time = 0.0
+        self.flush_timer = None
+        self.lock = threading.RLock()
+        # While batching, button reports are only sent by end_batch(), unless
+        # a button pressed in the batch is released before that.
+        self.batching = False
+        self.report_dirty = False
+        self.batch_pressed = 0x0000
+
+    def begin_batch(self):
+        with self.lock:
+            self.batching = True
+
+    def end_batch(self):
+        with self.lock:
+            self.batching = False
+            self.flush_batch()
+            if self.pending_dx or self.pending_dy or self.pending_dv or self.pending_dh:
+                self.schedule_flush()
+
+    def flush_batch(self):
+        self.batch_pressed = 0x0000
+        if self.report_dirty:
+            self.report_dirty = False
+            self.write_report()
 
     def button_down(self, button):
         if not check_button(button): return
-        self.active_buttons.add(button)
-        self.send_report()
+        with self.lock:
+            self.flush_motion()
+            if self.batching:
+                self.batch_pressed |= 1 << button
+            self.buttons |= 1 << button
+            self.send_report()
 
     def button_up(self, button):
         if not check_button(button): return
-        if button in self.active_buttons:
-            self.active_buttons.remove(button)
-        self.send_report()
+        with self.lock:
+            if self.batch_pressed & (1 << button):
+                # The host has to see the press before the release.
+                self.flush_batch()
+            self.flush_motion()
+            self.buttons &= ~(1 << button)
+            self.send_report()
 
     def click(self, button):
         if not check_button(button): return
@@ -39,20 +116,131 @@ class BluetoothMouse(object):
         dy = bound(dy, -32767, 32767)
         self.send_report(dx, dy)
 
+    def add_motion(self, dx, dy):
+        """Accumulate relative motion, sending at most one report per
+        poll interval."""
+        with self.lock:
+            self.pending_dx += dx
+            self.pending_dy += dy
+            self.schedule_flush()
+
+    def add_scroll(self, dv, dh):
+        """Accumulate scrolling, in wheel notches. Fractions of a notch are
+        reported when the host enabled high-resolution scrolling, vertical and
+        horizontal scrolling share a report."""
+        with self.lock:
+            # The boot mouse has no wheel.
+            if self.protocol == PROTOCOL_BOOT: return
+            self.pending_dv += dv * self.wheel_multiplier
+            self.pending_dh += dh * self.pan_multiplier
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.batching: return
+        elapsed = time.monotonic() - self.last_motion_time
+        if elapsed >= self.poll_interval:
+            self.flush_motion()
+        elif self.flush_timer is None:
+            self.flush_timer = self.hid_device.call_later(
+                self.poll_interval - elapsed, self.flush_motion)
+
+    def flush_motion(self):
+        """Send accumulated pointer and wheel motion, if any."""
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            limit = 127 if self.protocol == PROTOCOL_BOOT else 32767
+            dx = bound(int(self.pending_dx), -limit, limit)
+            dy = bound(int(self.pending_dy), -limit, limit)
+            dv = bound(int(self.pending_dv), -127, 127)
+            dh = bound(int(self.pending_dh), -127, 127)
+            if dx == 0 and dy == 0 and dv == 0 and dh == 0: return
+            # Button changes deferred by the batch go out before later motion.
+            if self.report_dirty:
+                self.flush_batch()
+            self.pending_dx -= dx
+            self.pending_dy -= dy
+            self.pending_dv -= dv
+            self.pending_dh -= dh
+            self.last_motion_time = time.monotonic()
+            self.send_report(dx, dy, dv, dh)
+
+    def discard_motion(self):
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            self.pending_dx = 0.0
+            self.pending_dy = 0.0
+            self.pending_dv = 0.0
+            self.pending_dh = 0.0
+
+    def set_protocol(self, protocol):
+        with self.lock:
+            self.protocol = protocol
+            self.pending_dv = 0.0
+            self.pending_dh = 0.0
+
+    def button_report(self):
+        """Report of the held buttons without motion, in the current protocol."""
+        if self.protocol == PROTOCOL_BOOT:
+            return encode_boot_button_report(self.buttons)
+        return encode_button_report(self.buttons)
+
+    def get_input_report(self, report_id):
+        """Current state as the input report report_id, or None if there
+        is no such report in the current protocol."""
+        if report_id == (BOOT_REPORT_ID if self.protocol == PROTOCOL_BOOT else MOUSE_REPORT_ID):
+            return self.button_report()
+        return None
+
+    def get_resolution_multiplier(self):
+        """Value of the Resolution Multiplier feature report: bits 0-1 for
+        the wheel, bits 2-3 for AC Pan."""
+        return ((0x01 if self.wheel_multiplier > 1 else 0) |
+                (0x04 if self.pan_multiplier > 1 else 0))
+
+    def set_resolution_multiplier(self, value):
+        with self.lock:
+            self.wheel_multiplier = HIRES_MULTIPLIER if value & 0x03 else 1
+            self.pan_multiplier = HIRES_MULTIPLIER if value & 0x0c else 1
+            self.pending_dv = 0.0
+            self.pending_dh = 0.0
+        logger.info("Scroll resolution: wheel %dx, pan %dx",
+                    self.wheel_multiplier, self.pan_multiplier)
+
     def wheel(self, dv=0, dh=0):
         dv = bound(dv, -127, 127)
         dh = bound(dh, -127, 127)
-        self.send_report(0, 0, dv, dh)
+        with self.lock:
+            self.flush_motion()
+            self.send_report(0, 0, dv, dh)
 
     def clear(self):
-        self.active_buttons.clear()
-        self.send_report()
+        with self.lock:
+            self.discard_motion()
+            self.buttons = 0x0000
+            self.send_report()
 
     def send_report(self, dx=0, dy=0, dv=0, dh=0):
-        buttons = 0x0
-        for button in self.active_buttons:
-            buttons |= 1 << button
-        message = bytes([0xa1, 0x03, buttons & 0xff, (buttons & 0xff00) >> 8,
-                         dx & 0xff, (dx & 0xff00) >> 8, dy & 0xff, (dy & 0xff00) >> 8,
-                         dv & 0xff, dh & 0xff])
-        self.hid_device.send_interrupt_message(message)
+        if not (dx or dy or dv or dh):
+            if self.batching:
+                self.report_dirty = True
+                return
+            self.write_report()
+            return
+        if self.protocol == PROTOCOL_BOOT:
+            if not (dx or dy): return
+            message = encode_boot_report(self.buttons, bound(dx, -127, 127),
+                                         bound(dy, -127, 127))
+            self.hid_device.send_interrupt_message(message, True)
+            return
+        message = encode_report(self.buttons, dx, dy, dv, dh)
+        # Pure motion reports may be dropped by a congested sender, button and
+        # wheel reports may not.
+        droppable = dv == 0 and dh == 0
+        self.hid_device.send_interrupt_message(message, droppable)
+
+    def write_report(self):
+        self.hid_device.send_interrupt_message(self.button_report())
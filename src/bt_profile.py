@@ -1,18 +1,29 @@
 import dbus
 import dbus.service
 import logging
-import os
+import socket
+import threading
 import collections
 
 logger = logging.getLogger(__name__)
 
+def device_address(device):
+    """Remote address of a BlueZ device object path, e.g.
+    /org/bluez/hci0/dev_AA_BB_CC_DD_EE_FF."""
+    return str(device).rsplit("/", 1)[-1][len("dev_"):].replace("_", ":")
+
 class BluetoothHIDProfile(dbus.service.Object):
     """Details: https://github.com/pauloborges/bluez/blob/master/doc/profile-api.txt"""
 
-    def __init__(self, bus, path, release_callback=None):
+    def __init__(self, bus, path, release_callback=None, connection_callback=None):
         super().__init__(bus, path)
         self.release_callback = release_callback
-        self.device_fd_map = collections.defaultdict(set)
+        # Called with the socket and remote address of every new connection.
+        self.connection_callback = connection_callback
+        # Sockets of each device until RequestDisconnection or forget().
+        self.device_sock_map = collections.defaultdict(set)
+        # NewConnection runs on the GLib loop, forget() on client threads.
+        self.lock = threading.Lock()
         logger.info("Registered HID profile at %s", path)
 
     @dbus.service.method("org.bluez.Profile1", in_signature="", out_signature="")
@@ -24,14 +35,32 @@ class BluetoothHIDProfile(dbus.service.Object):
     @dbus.service.method("org.bluez.Profile1", in_signature="oha{sv}", out_signature="")
     def NewConnection(self, device, fd, fd_properties):
         logger.info("New connection, fd = %r, device = %r", fd, device)
-        self.device_fd_map[device].add(fd.take())
+        sock = socket.socket(fileno=fd.take())
+        with self.lock:
+            self.device_sock_map[device].add(sock)
 
         for key, value in fd_properties.items():
             logger.info("%r = %r", key, value)
+        if self.connection_callback:
+            self.connection_callback(sock, device_address(device))
 
     @dbus.service.method("org.bluez.Profile1", in_signature="o", out_signature="")
     def RequestDisconnection(self, device):
         logger.info("RequestDisconnection, device = %r", device)
-        for fd in self.device_fd_map[device]:
-            os.close(fd)
-        del self.device_fd_map[device]
+        with self.lock:
+            socks = self.device_sock_map.pop(device, ())
+        for sock in socks:
+            # Wakes up a receiver blocked on the socket.
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def forget(self, sock):
+        """Drop sock once its user closed it."""
+        with self.lock:
+            for device, socks in list(self.device_sock_map.items()):
+                socks.discard(sock)
+                if not socks:
+                    del self.device_sock_map[device]
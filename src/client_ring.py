@@ -0,0 +1,93 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Number of clients that can be selected directly, with RightCtrl+F1 ~ F9.
+MAX_SLOTS = 9
+
+class Node(object):
+    __slots__ = ("client", "prev", "next", "slot")
+
+    def __init__(self, client, slot):
+        self.client = client
+        self.prev = self
+        self.next = self
+        self.slot = slot
+
+class ClientRing(object):
+    """Connected clients in connection order.
+
+    Adding, removing, stepping to the next or previous client and selecting
+    a client by slot number are all O(1). A client keeps its slot for as long
+    as it stays connected.
+
+    Clients are added and removed from the threads accepting and closing
+    them while input steps through the ring, so every method takes the
+    lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # remote address -> Node
+        self.nodes = {}
+        self.head = None
+        # slot number -> Node
+        self.slots = {}
+
+    def add(self, client):
+        with self.lock:
+            address = client.get_remote_address()
+            if address in self.nodes:
+                self.nodes[address].client = client
+                return
+            slot = None
+            for candidate in range(1, MAX_SLOTS + 1):
+                if candidate not in self.slots:
+                    slot = candidate
+                    break
+            node = Node(client, slot)
+            if slot is not None:
+                self.slots[slot] = node
+            if self.head is None:
+                self.head = node
+            else:
+                tail = self.head.prev
+                node.prev = tail
+                node.next = self.head
+                tail.next = node
+                self.head.prev = node
+            self.nodes[address] = node
+            logger.info("Client %s is in slot %s", address, slot)
+
+    def remove(self, address):
+        with self.lock:
+            node = self.nodes.pop(address, None)
+            if node is None: return
+            if node.slot is not None:
+                del self.slots[node.slot]
+            if node.next is node:
+                self.head = None
+                return
+            node.prev.next = node.next
+            node.next.prev = node.prev
+            if self.head is node:
+                self.head = node.next
+
+    def first(self):
+        with self.lock:
+            return self.head.client if self.head is not None else None
+
+    def step(self, address, step=1):
+        """The client step places after (or before, if negative) address."""
+        with self.lock:
+            node = self.nodes.get(address)
+            if node is None:
+                return self.head.client if self.head is not None else None
+            for i in range(abs(step)):
+                node = node.next if step > 0 else node.prev
+            return node.client
+
+    def get_slot(self, slot):
+        with self.lock:
+            node = self.slots.get(slot)
+            return node.client if node is not None else None
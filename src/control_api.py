@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""Local control API: other processes stream input to a client over a Unix
+socket.
+
+Every frame is a little-endian unsigned short length followed by that many
+bytes: an op code and its arguments. Requests:
+    OP_SELECT       address (utf-8), empty for the client input goes to
+    OP_KEY          usage: B, down: B
+    OP_MODIFIER     bit: B, down: B
+    OP_MEDIA        usage: H, down: B
+    OP_BUTTON       button: B, down: B
+    OP_MOTION       dx: h, dy: h
+    OP_WHEEL        dv: b, dh: b
+    OP_BATCH_BEGIN  hold reports until OP_BATCH_END
+    OP_BATCH_END
+Replies:
+    OP_ACK          frames handled so far: I, reports queued for the host: H
+    OP_ERROR        frame number: I, message (utf-8)
+
+The server acknowledges after handling what it read at once. It stops
+reading while the host has BACKPRESSURE_DEPTH reports queued, so a fast
+writer blocks instead of making the hub drop reports.
+"""
+
+import logging
+import os
+import socket
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+OP_SELECT = 0x01
+OP_KEY = 0x02
+OP_MODIFIER = 0x03
+OP_MEDIA = 0x04
+OP_BUTTON = 0x05
+OP_MOTION = 0x06
+OP_WHEEL = 0x07
+OP_BATCH_BEGIN = 0x08
+OP_BATCH_END = 0x09
+OP_ACK = 0x80
+OP_ERROR = 0x81
+
+FRAME_HEADER = struct.Struct("<H")
+KEY = struct.Struct("<BB")
+MEDIA = struct.Struct("<HB")
+MOTION = struct.Struct("<hh")
+WHEEL = struct.Struct("<bb")
+ACK = struct.Struct("<IH")
+ERROR = struct.Struct("<I")
+
+RECV_SIZE = 65536
+
+# Reports queued for the target host at which the server stops reading.
+BACKPRESSURE_DEPTH = 16
+
+class ControlError(Exception):
+    pass
+
+def encode_frame(op, payload=b""):
+    return FRAME_HEADER.pack(len(payload) + 1) + bytes([op]) + payload
+
+class ControlConnection(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.forwarder = server.forwarder
+        # None follows the client input goes to.
+        self.target_address = None
+        self.frames = 0
+        # Targets between OP_BATCH_BEGIN and OP_BATCH_END, ended when the
+        # connection closes so they do not hold reports back forever.
+        self.batches = []
+        # Error replies of the frames handled in the loop, sent from the
+        # connection thread: a client that does not read them must not
+        # block the loop.
+        self.errors = []
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def worker(self):
+        buf = bytearray()
+        while True:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except OSError:
+                break
+            if not data: break
+            buf += data
+            frames = []
+            pos = 0
+            while len(buf) - pos >= FRAME_HEADER.size:
+                length = FRAME_HEADER.unpack_from(buf, pos)[0]
+                end = pos + FRAME_HEADER.size + length
+                if end > len(buf): break
+                frames.append(bytes(buf[pos + FRAME_HEADER.size:end]))
+                pos = end
+            del buf[:pos]
+            # In slices, so the host queue stays around BACKPRESSURE_DEPTH
+            # however much was read at once.
+            for start in range(0, len(frames), BACKPRESSURE_DEPTH):
+                self.wait_for_host()
+                self.run_in_loop(self.handle_frames, frames[start:start + BACKPRESSURE_DEPTH])
+                self.send_errors()
+            self.reply(OP_ACK, ACK.pack(self.frames, min(self.queue_depth(), 0xffff)))
+        logger.info("Control connection closed after %d frames", self.frames)
+        if self.batches:
+            self.run_in_loop(self.end_batches)
+        self.sock.close()
+
+    def run_in_loop(self, callback, *args):
+        """Run callback where input is handled, the only thread allowed to
+        touch clients: the engine loop if there is one, the input thread
+        otherwise. Input devices that can not run callbacks for others (e.g.
+        benchmark.ReplayInput) get them called from here."""
+        loop = self.forwarder.engine
+        if loop is None:
+            loop = self.forwarder.input_device
+        def run():
+            # An exception would stop the input thread.
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Control frames failed")
+            finally:
+                done.set()
+        done = threading.Event()
+        if hasattr(loop, "call_soon_threadsafe"):
+            loop.call_soon_threadsafe(run)
+        else:
+            run()
+        done.wait()
+
+    def end_batches(self):
+        for target in self.batches:
+            target.keyboard.end_batch()
+            target.mouse.end_batch()
+        self.batches = []
+
+    def handle_frames(self, frames):
+        for frame in frames:
+            self.frames += 1
+            try:
+                self.handle(frame)
+            except (ControlError, struct.error, IndexError, ValueError) as e:
+                self.errors.append((self.frames, str(e)))
+            except Exception as e:
+                logger.exception("Control frame %d failed", self.frames)
+                self.errors.append((self.frames, str(e)))
+
+    def send_errors(self):
+        errors, self.errors = self.errors, []
+        for frame, message in errors:
+            self.reply(OP_ERROR, ERROR.pack(frame) + message.encode())
+
+    def reply(self, op, payload):
+        try:
+            self.sock.sendall(encode_frame(op, payload))
+        except OSError:
+            pass
+
+    def get_target(self):
+        if self.target_address is None:
+            target = self.forwarder.client
+        else:
+            target = self.forwarder.clients.get(self.target_address)
+        if target is None:
+            raise ControlError("not connected")
+        return target
+
+    def queue_depth(self):
+        try:
+            return self.get_target().queue_depth()
+        except ControlError:
+            return 0
+
+    def wait_for_host(self):
+        try:
+            target = self.get_target()
+        except ControlError:
+            return
+        target.wait_for_queue(BACKPRESSURE_DEPTH)
+
+    def handle(self, frame):
+        op = frame[0]
+        if op == OP_SELECT:
+            address = frame[1:].decode()
+            if address and address not in self.forwarder.clients:
+                raise ControlError("unknown client %s" % address)
+            self.target_address = address or None
+            return
+        target = self.get_target()
+        if op == OP_KEY:
+            usage, down = KEY.unpack_from(frame, 1)
+            if down:
+                target.keyboard.key_down(usage)
+            else:
+                target.keyboard.key_up(usage)
+        elif op == OP_MODIFIER:
+            bit, down = KEY.unpack_from(frame, 1)
+            if down:
+                target.keyboard.modifier_down(bit)
+            else:
+                target.keyboard.modifier_up(bit)
+        elif op == OP_MEDIA:
+            usage, down = MEDIA.unpack_from(frame, 1)
+            if down:
+                target.keyboard.media_key_down(usage)
+            else:
+                target.keyboard.media_key_up(usage)
+        elif op == OP_BUTTON:
+            button, down = KEY.unpack_from(frame, 1)
+            if down:
+                target.mouse.button_down(button)
+            else:
+                target.mouse.button_up(button)
+        elif op == OP_MOTION:
+            target.mouse.add_motion(*MOTION.unpack_from(frame, 1))
+        elif op == OP_WHEEL:
+            target.mouse.add_scroll(*WHEEL.unpack_from(frame, 1))
+        elif op == OP_BATCH_BEGIN:
+            target.keyboard.begin_batch()
+            target.mouse.begin_batch()
+            if target not in self.batches:
+                self.batches.append(target)
+        elif op == OP_BATCH_END:
+            target.keyboard.end_batch()
+            target.mouse.end_batch()
+            if target in self.batches:
+                self.batches.remove(target)
+        else:
+            raise ControlError("unknown op %#x" % op)
+
+class ControlServer(object):
+    """Serves the control API for a Forwarder on a Unix socket."""
+
+    def __init__(self, forwarder, path):
+        self.forwarder = forwarder
+        self.path = path
+        self.sock = None
+        self.thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(4)
+        logger.info("Control API listening on %s", self.path)
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def worker(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                break
+            logger.info("New control connection")
+            ControlConnection(self, sock).start()
+
+    def close(self):
+        self.sock.close()
+        os.unlink(self.path)
+
+class ControlClient(object):
+    """Client side of the control API.
+
+    Frames are buffered and sent by flush(), or once the buffer fills up.
+    At most window frames are in flight: past that, sending waits for the
+    hub to acknowledge them."""
+
+    def __init__(self, path, window=1024, buffer_size=4096):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.window = window
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.recv_buffer = bytearray()
+        self.sent = 0
+        self.buffered = 0
+        self.acked = 0
+        self.queue_depth = 0
+        self.errors = []
+
+    def send(self, op, payload=b""):
+        self.buffer += encode_frame(op, payload)
+        self.buffered += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer: return
+        # Acks are read as they come, so they never fill up the socket.
+        self.read_replies(block=False)
+        while self.sent - self.acked >= self.window:
+            self.read_replies()
+        self.sock.sendall(self.buffer)
+        self.sent += self.buffered
+        self.buffered = 0
+        self.buffer.clear()
+
+    def read_replies(self, block=True):
+        try:
+            data = self.sock.recv(RECV_SIZE, 0 if block else socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionError("control connection closed")
+        self.recv_buffer += data
+        pos = 0
+        while len(self.recv_buffer) - pos >= FRAME_HEADER.size:
+            length = FRAME_HEADER.unpack_from(self.recv_buffer, pos)[0]
+            end = pos + FRAME_HEADER.size + length
+            if end > len(self.recv_buffer): break
+            op = self.recv_buffer[pos + FRAME_HEADER.size]
+            payload = bytes(self.recv_buffer[pos + FRAME_HEADER.size + 1:end])
+            if op == OP_ACK:
+                self.acked, self.queue_depth = ACK.unpack_from(payload)
+            elif op == OP_ERROR:
+                frame = ERROR.unpack_from(payload)[0]
+                self.errors.append((frame, payload[ERROR.size:].decode()))
+                logger.error("Frame %d failed: %s", *self.errors[-1])
+            pos = end
+        del self.recv_buffer[:pos]
+
+    def sync(self):
+        """Wait until the hub handled every frame sent so far."""
+        self.flush()
+        while self.acked < self.sent:
+            self.read_replies()
+
+    def close(self):
+        self.sync()
+        self.sock.close()
+
+    def select(self, address=""):
+        self.send(OP_SELECT, address.encode())
+
+    def key(self, usage, down):
+        self.send(OP_KEY, KEY.pack(usage, down))
+
+    def modifier(self, bit, down):
+        self.send(OP_MODIFIER, KEY.pack(bit, down))
+
+    def media_key(self, usage, down):
+        self.send(OP_MEDIA, MEDIA.pack(usage, down))
+
+    def button(self, button, down):
+        self.send(OP_BUTTON, KEY.pack(button, down))
+
+    def motion(self, dx, dy):
+        self.send(OP_MOTION, MOTION.pack(dx, dy))
+
+    def wheel(self, dv, dh):
+        self.send(OP_WHEEL, WHEEL.pack(dv, dh))
+
+    def begin_batch(self):
+        self.send(OP_BATCH_BEGIN)
+
+    def end_batch(self):
+        self.send(OP_BATCH_END)
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Type keyboard usage IDs read from stdin, "
+                                     "one per line, into a host.")
+    parser.add_argument("path", help="control socket of the hub")
+    parser.add_argument("--address", default="", help="client to send to")
+    args = parser.parse_args()
+    client = ControlClient(args.path)
+    client.select(args.address)
+    for line in sys.stdin:
+        line = line.strip()
+        if not line: continue
+        usage = int(line, 0)
+        client.key(usage, True)
+        client.key(usage, False)
+    client.close()
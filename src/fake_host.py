@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+import bt_hid
+import hid_descriptor
+
+logger = logging.getLogger(__name__)
+
+def decode_report(message):
+    """Decode an input report sent by the hub into (kind, fields)."""
+    if len(message) < 2 or message[0] != 0xa1:
+        return ("unknown", bytes(message))
+    report_id = message[1]
+    if report_id == 0x01:
+        keys = tuple(key for key in message[4:10] if key)
+        return ("keyboard", (message[2], keys))
+    if report_id == 0x04:
+        keys = tuple(key for key in range(0xe0) if message[3 + (key >> 3)] & (1 << (key & 7)))
+        return ("keyboard", (message[2], keys))
+    if report_id == 0x02:
+        return ("media", (message[2] | message[3] << 8,))
+    if report_id == 0x03:
+        return ("mouse", hid_descriptor.MOUSE.unpack(message))
+    return ("unknown", bytes(message))
+
+class FakeHost(object):
+    """A host that connects to the hub over a local transport and keeps track
+    of the state described by the reports it receives."""
+
+    def __init__(self, hid_transport, address):
+        self.address = address
+        self.control_sock = hid_transport.connect(address, bt_hid.PORT_CONTROL)
+        self.interrupt_sock = hid_transport.connect(address, bt_hid.PORT_INTERRUPT)
+        self.reports = 0
+        self.bytes = 0
+        self.kinds = {}
+        self.first_report_time = None
+        self.last_report_time = None
+        self.modifiers = 0
+        self.keys = ()
+        self.media = 0
+        self.buttons = 0
+        self.x = 0
+        self.y = 0
+        self.wheel = 0
+        self.pan = 0
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def worker(self):
+        while True:
+            try:
+                msg = self.interrupt_sock.recv(4096)
+            except OSError:
+                break
+            if not msg: break
+            self.handle_report(msg)
+        logger.info("Host %s disconnected", self.address)
+
+    def handle_report(self, msg):
+        now = time.monotonic()
+        if self.first_report_time is None:
+            self.first_report_time = now
+        self.last_report_time = now
+        self.reports += 1
+        self.bytes += len(msg)
+        kind, fields = decode_report(msg)
+        self.kinds[kind] = self.kinds.get(kind, 0) + 1
+        if kind == "keyboard":
+            self.modifiers, self.keys = fields
+        elif kind == "media":
+            self.media = fields[0]
+        elif kind == "mouse":
+            self.buttons, dx, dy, dv, dh = fields
+            self.x += dx
+            self.y += dy
+            self.wheel += dv
+            self.pan += dh
+
+    def close(self):
+        self.control_sock.close()
+        self.interrupt_sock.close()
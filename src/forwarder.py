@@ -1,14 +1,24 @@
 #!/usr/bin/env python3
 
 import logging
-import input
+import os
+import time
 import bt_hid
+import client_ring
+import diagnostics
+import host_registry
+import keymap
+import latency
+import metrics
 from libinput.evcodes import Key, Button
 import dbus.mainloop.glib
 import gi
 from gi.repository import GLib
 import threading
 
+# When the modules above were loaded, the first startup milestone.
+IMPORT_TIME = time.monotonic()
+
 logger = logging.getLogger(__name__)
 
 MODIFIER_CODES = {
@@ -193,36 +203,264 @@ BUTTON_CODES = {
     Button.BTN_EXTRA: 4,
 }
 
-def get_modifier_code(key):
-    return MODIFIER_CODES.get(key, None)
+def get_button_code(button):
+    return BUTTON_CODES.get(button, None)
 
-def get_key_code(key):
-    return KEY_CODES.get(key, None)
+# RightCtrl+Pause switches to the next client, RightCtrl+RightShift+Pause to
+# the previous one.
+SWITCH_KEYS = (Key.KEY_RIGHTCTRL, Key.KEY_PAUSE)
 
-def get_media_key_code(key):
-    return MEDIA_KEY_CODES.get(key, None)
+# RightCtrl+F<n> switches to the client in slot n.
+DIRECT_SWITCH_KEYS = {
+    Key.KEY_F1: 1,
+    Key.KEY_F2: 2,
+    Key.KEY_F3: 3,
+    Key.KEY_F4: 4,
+    Key.KEY_F5: 5,
+    Key.KEY_F6: 6,
+    Key.KEY_F7: 7,
+    Key.KEY_F8: 8,
+    Key.KEY_F9: 9,
+}
 
-def get_button_code(button):
-    return BUTTON_CODES.get(button, None)
+BROADCAST_KEYS = (Key.KEY_RIGHTCTRL, Key.KEY_SCROLLLOCK)
 
 def has_switch_keys(active_keys):
     return Key.KEY_RIGHTCTRL in active_keys and Key.KEY_PAUSE in active_keys
 
+def has_broadcast_keys(active_keys):
+    return Key.KEY_RIGHTCTRL in active_keys and Key.KEY_SCROLLLOCK in active_keys
+
+def get_direct_switch_slot(active_keys):
+    if Key.KEY_RIGHTCTRL not in active_keys:
+        return None
+    for key in active_keys:
+        slot = DIRECT_SWITCH_KEYS.get(key)
+        if slot is not None:
+            return slot
+    return None
+
+def discard_log(event_type):
+    return diagnostics.RateLimitedLog(
+        logger, logging.WARNING, "Discard %s event, not connected" % event_type,
+        "Discarded {count:,} %s events in the last {seconds:.0f}s, not connected" % event_type)
+
+DISCARD_KEY_LOG = discard_log("key")
+DISCARD_MOTION_LOG = discard_log("motion")
+DISCARD_BUTTON_LOG = discard_log("button")
+DISCARD_WHEEL_LOG = discard_log("wheel")
+UNKNOWN_KEY_LOG = diagnostics.RateLimitedLog(
+    logger, logging.WARNING, "Unknown key: %r",
+    "Unknown keys pressed {count:,} more times in the last {seconds:.0f}s")
+UNKNOWN_BUTTON_LOG = diagnostics.RateLimitedLog(
+    logger, logging.WARNING, "Unknown button: %r",
+    "Unknown buttons pressed {count:,} more times in the last {seconds:.0f}s")
+
+# With --keepalive, idle clients get a report at least this often, in
+# seconds, so their links stay in active mode and switching to them does not
+# wait for a sniff interval to pass. Off by default: hosts may take the
+# reports for user activity and never lock the screen or sleep.
+DEFAULT_KEEPALIVE_INTERVAL = 0
+
+class BackgroundCall(object):
+    """Runs function on its own thread. result() waits for it, and returns
+    what it returned or raises what it raised."""
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def worker(self):
+        try:
+            self.value = self.function(*self.args)
+        except BaseException as e:
+            self.error = e
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
 class Forwarder(object):
-    def __init__(self, data_path):
+    def __init__(self, data_path, use_asyncio=False, latency_interval=0,
+                 track_latency=False, input_device=None, hid_transport=None,
+                 register_profile=True, keymap_file=None, nkro=False,
+                 broadcast_addresses=None, batch=False,
+                 keepalive_interval=DEFAULT_KEEPALIVE_INTERVAL, remember_hosts=True,
+                 profile_channels=False, recorder=None, control_socket=None,
+                 metrics_port=None):
+        self.timeline = latency.Timeline()
+        self.timeline.mark(latency.MILESTONE_IMPORTED, IMPORT_TIME)
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-        self.input_device = input.Input()
-        self.hid_device = bt_hid.BluetoothHID(data_path)
-        self.hid_device.init()
-        self.input_device.register_callbacks(
-            self.key_callback, self.mouse_move_callback,
-            self.mouse_button_callback, self.mouse_wheel_callback)
+        if use_asyncio:
+            import async_engine
+            self.engine = async_engine.AsyncEngine()
+        else:
+            self.engine = None
+        # Served on localhost when metrics_port is set.
+        self.metrics = metrics.Registry()
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.wait_client_thread = None
+        self.forward_thread = None
+        self.init_metrics()
+        # Latency tracking is only enabled when it is reported somewhere.
+        self.latency_interval = latency_interval
+        if track_latency or latency_interval > 0:
+            self.latency = latency.LatencyTracker()
+        else:
+            self.latency = None
+        # libinput enumerates devices on its own thread, while the sockets
+        # and the profile are set up here.
+        input_call = None
+        if input_device is None:
+            input_call = BackgroundCall(self.create_input)
+        else:
+            input_device.latency = self.latency
+        if remember_hosts:
+            self.hosts = host_registry.HostRegistry(
+                os.path.join(data_path, host_registry.HOSTS_FILENAME))
+        else:
+            self.hosts = None
+        self.hid_device = bt_hid.BluetoothHID(data_path, self.engine, self.latency,
+                                              hid_transport, nkro, self.hosts,
+                                              profile_channels, self.timeline)
+        # Listening before the profile is advertised, so hosts connecting
+        # right away wait in the backlog until accepted.
+        self.hid_device.listen()
+        self.timeline.mark(latency.MILESTONE_LISTENING)
+        if register_profile:
+            self.hid_device.init()
+        if input_call is not None:
+            input_device = input_call.result()
+        self.input_device = input_device
+        # A recording.Recorder which sees every input event and report.
+        self.recorder = recorder
+        # Path of the Unix socket to serve the control API on, if any.
+        self.control_socket = control_socket
+        self.control_server = None
+        callbacks = (self.key_callback, self.mouse_move_callback,
+                     self.mouse_button_callback, self.mouse_wheel_callback)
+        batch_callbacks = (self.begin_batch, self.end_batch) if batch else (None, None)
+        if recorder is not None:
+            callbacks = recorder.wrap_input(*callbacks)
+            batch_callbacks = recorder.wrap_batch(*batch_callbacks)
+        self.input_device.register_callbacks(*callbacks)
+        if batch_callbacks[0] is not None:
+            self.input_device.register_batch_callbacks(*batch_callbacks)
+        # Client whose reports are held back until the end of the batch.
+        self.batch_client = None
         self.clients = {}
+        # Same clients, in the order switching visits them.
+        self.ring = client_ring.ClientRing()
+        # Set once the user switched clients with a hotkey, after which
+        # reconnecting hosts no longer take over input.
+        self.ring_switched = False
         self.client = None
+        self.keepalive_interval = keepalive_interval
+        # While broadcasting, self.client is the broadcast group and
+        # unicast_client the client to return to afterwards.
+        self.broadcast = None
+        self.broadcast_addresses = None
+        self.unicast_client = None
         self.active_keys = set()
         self.ignore_keys = set()
+        self.keymap = keymap.Keymap(MODIFIER_CODES, KEY_CODES, MEDIA_KEY_CODES,
+                                    SWITCH_KEYS + BROADCAST_KEYS +
+                                    tuple(DIRECT_SWITCH_KEYS))
+        if keymap_file:
+            self.keymap.load(keymap_file)
+        if broadcast_addresses is not None:
+            self.start_broadcast(broadcast_addresses or None)
+
+    def init_metrics(self):
+        registry = self.metrics
+        events_help = "Input events handled"
+        self.key_events = registry.counter("bthub_input_events_total", events_help, type="key")
+        self.motion_events = registry.counter("bthub_input_events_total", events_help,
+                                              type="motion")
+        self.button_events = registry.counter("bthub_input_events_total", events_help,
+                                              type="button")
+        self.wheel_events = registry.counter("bthub_input_events_total", events_help,
+                                             type="wheel")
+        self.discarded_events = registry.counter(
+            "bthub_discarded_events_total", "Input events discarded while no host was connected")
+        self.switches = registry.counter("bthub_switches_total",
+                                         "Times input was switched to another host")
+        self.connections = registry.counter("bthub_connections_total", "Hosts connected")
+        self.disconnections = registry.counter("bthub_disconnections_total",
+                                               "Hosts disconnected")
+        self.reconnects = registry.counter("bthub_reconnects_total",
+                                           "Known hosts the hub connected to")
+        self.reconnect_failures = registry.counter(
+            "bthub_reconnect_failures_total", "Known hosts the hub failed to connect to")
+        self.send_errors = registry.counter(
+            "bthub_send_errors_total", "Reports that failed to send, closing their host")
+        registry.gauge("bthub_clients", "Connected hosts", lambda: len(self.clients))
+        registry.gauge("bthub_profile_registered", "Whether BlueZ has the HID profile",
+                       lambda: self.hid_device.registered)
+        for name, metric_type, help_text in (
+                ("bthub_client_reports_total", metrics.COUNTER, "Reports sent to a host"),
+                ("bthub_client_report_bytes_total", metrics.COUNTER,
+                 "Bytes of reports sent to a host"),
+                ("bthub_client_reports_dropped_total", metrics.COUNTER,
+                 "Motion reports dropped because a host was slow"),
+                ("bthub_client_queue_depth", metrics.GAUGE, "Reports queued for a host"),
+                ("bthub_client_thread_alive", metrics.GAUGE,
+                 "Whether a thread serving a host is running"),
+                ("bthub_thread_alive", metrics.GAUGE, "Whether a thread of the hub is running")):
+            registry.describe(name, metric_type, help_text)
+        registry.describe("bthub_startup_seconds", metrics.GAUGE,
+                          "When a startup milestone was reached, since the process started")
+        registry.add_collector(self.collect_client_metrics)
+        registry.add_collector(self.collect_thread_metrics)
+        registry.add_collector(lambda: [
+            ("bthub_startup_seconds", {"milestone": milestone}, seconds)
+            for milestone, seconds in self.timeline.get_milestones()])
+
+    def collect_client_metrics(self):
+        samples = []
+        for address, client in list(self.clients.items()):
+            stats = client.get_stats()
+            labels = {"client": address}
+            samples.append(("bthub_client_reports_total", labels, stats["sent"]))
+            samples.append(("bthub_client_report_bytes_total", labels, stats["sent_bytes"]))
+            samples.append(("bthub_client_reports_dropped_total", labels, stats["dropped"]))
+            samples.append(("bthub_client_queue_depth", labels, stats["queue_depth"]))
+            for name, alive in client.get_threads().items():
+                samples.append(("bthub_client_thread_alive",
+                                {"client": address, "thread": name}, alive))
+        return samples
+
+    def collect_thread_metrics(self):
+        threads = {"accept": self.wait_client_thread, "input": self.forward_thread}
+        if self.engine is not None:
+            threads["glib"] = self.engine.glib_thread
+        if self.control_server is not None:
+            threads["control_api"] = self.control_server.thread
+        return [("bthub_thread_alive", {"thread": name}, thread.is_alive())
+                for name, thread in threads.items() if thread is not None]
+
+    def create_input(self):
+        # libinput is only loaded when it is used.
+        import input
+        input_device = input.Input(self.latency)
+        self.timeline.mark(latency.MILESTONE_INPUT_READY)
+        return input_device
+
+    def mark_callback(self):
+        if self.latency is not None:
+            self.latency.mark(latency.STAGE_CALLBACK)
 
     def key_callback(self, key, down):
+        self.mark_callback()
+        self.key_events.inc()
         if down:
             self.active_keys.add(key)
         else:
@@ -231,51 +469,84 @@ class Forwarder(object):
             if key in self.ignore_keys:
                 self.ignore_keys.remove(key)
             return
-        if has_switch_keys(self.active_keys):
-            logger.info("Switching client")
-            self.switch_client()
+        action, code, hotkey = self.keymap.lookup(key)
+        if hotkey and self.handle_hotkey():
             self.ignore_keys.clear()
             self.ignore_keys.update(self.active_keys)
             return
         if self.client is None:
-            logger.warning("Discard event, not connected")
+            DISCARD_KEY_LOG()
+            self.discarded_events.inc()
             return
-        modifier_code = get_modifier_code(key)
-        if modifier_code is not None:
+        if action == keymap.ACTION_KEY:
             if down:
-                self.client.keyboard.modifier_down(modifier_code)
+                self.client.keyboard.key_down(code)
             else:
-                self.client.keyboard.modifier_up(modifier_code)
-            return
-        key_code = get_key_code(key)
-        if key_code is not None:
+                self.client.keyboard.key_up(code)
+        elif action == keymap.ACTION_MODIFIER:
             if down:
-                self.client.keyboard.key_down(key_code)
+                self.client.keyboard.modifier_down(code)
             else:
-                self.client.keyboard.key_up(key_code)
-            return
-        key_code = get_media_key_code(key)
-        if key_code is not None:
+                self.client.keyboard.modifier_up(code)
+        elif action == keymap.ACTION_MEDIA:
             if down:
-                self.client.keyboard.media_key_down(key_code)
+                self.client.keyboard.media_key_down(code)
             else:
-                self.client.keyboard.media_key_up(key_code)
-            return
-        logger.warning("Unknown key: %r", key)
+                self.client.keyboard.media_key_up(code)
+        else:
+            UNKNOWN_KEY_LOG(key)
+
+    def begin_batch(self):
+        self.batch_client = self.client
+        if self.batch_client is not None:
+            self.batch_client.keyboard.begin_batch()
+            self.batch_client.mouse.begin_batch()
+
+    def end_batch(self):
+        # Still the client from begin_batch(), even if a hotkey switched away
+        # from it during the batch.
+        if self.batch_client is not None:
+            self.batch_client.keyboard.end_batch()
+            self.batch_client.mouse.end_batch()
+            self.batch_client = None
+
+    def handle_hotkey(self):
+        if has_switch_keys(self.active_keys):
+            self.ring_switched = True
+            self.switch_client(-1 if Key.KEY_RIGHTSHIFT in self.active_keys else 1)
+            return True
+        slot = get_direct_switch_slot(self.active_keys)
+        if slot is not None:
+            self.ring_switched = True
+            self.switch_to_slot(slot)
+            return True
+        if has_broadcast_keys(self.active_keys):
+            if self.broadcast is None:
+                self.start_broadcast()
+            else:
+                self.stop_broadcast()
+            return True
+        return False
 
     def mouse_move_callback(self, dx, dy):
+        self.mark_callback()
+        self.motion_events.inc()
         if self.client is None:
-            logger.warning("Discard event, not connected")
+            DISCARD_MOTION_LOG()
+            self.discarded_events.inc()
             return
-        self.client.mouse.move(int(dx), int(dy))
+        self.client.mouse.add_motion(dx, dy)
 
     def mouse_button_callback(self, button, down):
+        self.mark_callback()
+        self.button_events.inc()
         if self.client is None:
-            logger.warning("Discard event, not connected")
+            DISCARD_BUTTON_LOG()
+            self.discarded_events.inc()
             return
         button_code = get_button_code(button)
         if button_code is None:
-            logger.warning("Unknown button: %r", button)
+            UNKNOWN_BUTTON_LOG(button)
             return
         if down:
             self.client.mouse.button_down(button_code)
@@ -283,49 +554,217 @@ class Forwarder(object):
             self.client.mouse.button_up(button_code)
 
     def mouse_wheel_callback(self, dv, dh):
-        normalize = lambda x: 0 if x == 0 else -int(x/abs(x))
+        self.mark_callback()
+        self.wheel_events.inc()
         if self.client is None:
-            logger.warning("Discard event, not connected")
+            DISCARD_WHEEL_LOG()
+            self.discarded_events.inc()
             return
-        self.client.mouse.wheel(normalize(dv), normalize(dh))
+        # libinput scrolls down for positive values, HID scrolls up.
+        self.client.mouse.add_scroll(-dv, -dh)
 
     def wait_client(self):
         while True:
             client = self.hid_device.accept(self.client_closed)
-            self.clients[client.get_remote_address()] = client
-            if self.client is None:
-                self.client = client
+            self.client_accepted(client)
+
+    def client_accepted(self, client):
+        if self.recorder is not None:
+            client.report_callback = self.recorder.report
+        self.connections.inc()
+        self.timeline.mark(latency.MILESTONE_FIRST_CONNECTION)
+        self.clients[client.get_remote_address()] = client
+        self.ring.add(client)
+        if self.broadcast is not None:
+            if self.is_broadcast_target(client.get_remote_address()):
+                self.broadcast.add(client)
+            if self.unicast_client is None:
+                self.unicast_client = client
+        elif self.client is None:
+            self.client = client
+
+    def reconnect_hosts(self):
+        """Connect to every known host at once, instead of waiting for them
+        to reconnect on their own."""
+        for address in self.hosts.get_hosts():
+            thread = threading.Thread(target=self.reconnect_host, args=(address,))
+            thread.daemon = True
+            thread.start()
+
+    def reconnect_host(self, address):
+        try:
+            channels = self.hid_device.connect(address)
+        except OSError as e:
+            logger.info("Failed to reconnect to %s: %s", address, e)
+            self.reconnect_failures.inc()
+            return
+        # Clients are only changed where input is handled.
+        if self.engine is not None:
+            self.engine.call_soon_threadsafe(self.host_reconnected, address, channels)
+        elif hasattr(self.input_device, "call_soon_threadsafe"):
+            self.input_device.call_soon_threadsafe(self.host_reconnected, address, channels)
+        else:
+            self.host_reconnected(address, channels)
+
+    def host_reconnected(self, address, channels):
+        if address in self.clients:
+            # The host was faster and connected to us.
+            for channel in channels:
+                channel.close()
+            return
+        logger.info("Reconnected to %s", address)
+        self.reconnects.inc()
+        client = self.hid_device.create_client(channels[0], channels[1], address,
+                                               self.client_closed)
+        self.client_accepted(client)
+        # Input goes to the host used last, if it is back.
+        if (self.broadcast is None and self.client is not client and
+                address == self.hosts.get_hosts()[0] and not self.ring_switched):
+            self.select_client(client)
 
     def client_closed(self, remote_address):
         if remote_address in self.clients:
-            del self.clients[remote_address]
-            if self.client and self.client.get_remote_address() == remote_address:
+            client = self.clients.pop(remote_address)
+            self.ring.remove(remote_address)
+            self.disconnections.inc()
+            self.send_errors.inc(client.get_stats()["errors"])
+            if self.broadcast is not None:
+                self.broadcast.remove(client)
+                if self.unicast_client is client:
+                    self.unicast_client = None
+            elif self.client and self.client.get_remote_address() == remote_address:
                 self.client = None
                 self.switch_client()
         else:
             logger.error("Unknown client %s closed", remote_address)
 
-    def switch_client(self):
+    def is_broadcast_target(self, address):
+        return self.broadcast_addresses is None or address in self.broadcast_addresses
+
+    def start_broadcast(self, addresses=None):
+        """Mirror input to the clients in addresses, or to every client
+        (including those connecting later) when addresses is None."""
+        if self.broadcast is not None:
+            self.stop_broadcast()
+        if self.client is not None:
+            self.client.keyboard.clear()
+            self.client.mouse.clear()
+        self.broadcast_addresses = set(addresses) if addresses is not None else None
+        members = [client for address, client in self.clients.items()
+                   if self.is_broadcast_target(address)]
+        self.broadcast = self.hid_device.create_broadcast_group(members)
+        if self.recorder is not None:
+            self.broadcast.report_callback = self.recorder.report
+        logger.info("Broadcasting to %s", "all clients" if addresses is None
+                    else ", ".join(sorted(self.broadcast_addresses)))
+        self.unicast_client = self.client
+        self.client = self.broadcast
+
+    def stop_broadcast(self):
+        if self.broadcast is None: return
+        self.broadcast.keyboard.clear()
+        self.broadcast.mouse.clear()
+        self.broadcast.close()
+        logger.info("Stopped broadcasting")
+        self.client = self.unicast_client
+        self.broadcast = None
+        self.broadcast_addresses = None
+        self.unicast_client = None
+
+    def switch_client(self, step=1):
+        """Switch to the client step places after the current one, or before
+        it if step is negative."""
+        if self.broadcast is not None:
+            # Switching leaves broadcast mode, back to the previous client.
+            self.stop_broadcast()
+            return
         if not self.clients:
             logger.warning("No client to switch to")
             return
-        client_addresses = list(self.clients.keys())
         if self.client is None:
-            client_index = -1
+            self.select_client(self.ring.first())
         else:
+            self.select_client(self.ring.step(self.client.get_remote_address(), step))
+
+    def switch_to_slot(self, slot):
+        client = self.ring.get_slot(slot)
+        if client is None:
+            logger.warning("No client in slot %d", slot)
+            return
+        if self.broadcast is not None:
+            self.stop_broadcast()
+        self.select_client(client)
+
+    def select_client(self, client):
+        if client is self.client: return
+        if self.client is not None:
+            # Only queued, so the new client does not wait for the old one.
             self.client.keyboard.clear()
             self.client.mouse.clear()
-            client_index = client_addresses.index(self.client.get_remote_address())
-        client_index = (client_index + 1) % len(client_addresses)
-        new_address = client_addresses[client_index]
-        logger.info("Switching to %s", new_address)
-        self.client = self.clients[new_address]
+        logger.info("Switching to %s", client.get_remote_address())
+        self.switches.inc()
+        client.begin_switch()
+        self.client = client
+        if self.hosts is not None:
+            self.hosts.use(client.get_remote_address(), client.protocol)
 
-    def run(self):
-        self.hid_device.listen()
+    def keep_alive(self):
+        members = self.broadcast.members if self.broadcast is not None else ()
+        for client in list(self.clients.values()):
+            # Broadcast members already get every report, and their own
+            # state is not what the host sees.
+            if client is not self.client and client not in members:
+                client.keep_alive()
+
+    def add_periodic(self, interval, callback):
+        """Run callback every interval seconds, on the engine loop if there
+        is one."""
+        if self.engine is not None:
+            def tick():
+                callback()
+                self.engine.call_later(interval, tick)
+            self.engine.call_later(interval, tick)
+        else:
+            GLib.timeout_add(int(interval * 1000), lambda: callback() or True)
+
+    def log_latency(self):
+        self.latency.log_summary()
+
+    def start_control_server(self):
+        import control_api
+        self.control_server = control_api.ControlServer(self, self.control_socket)
+        self.control_server.start()
+
+    def start_metrics_server(self):
+        self.metrics_server = metrics.MetricsServer(self.metrics, self.metrics_port)
+        self.metrics_server.start()
+
+    def start_accepting(self):
         self.wait_client_thread = threading.Thread(target=self.wait_client)
         self.wait_client_thread.daemon = True
         self.wait_client_thread.start()
+
+    def run(self):
+        if self.latency_interval > 0:
+            self.add_periodic(self.latency_interval, self.log_latency)
+        if self.keepalive_interval > 0:
+            self.add_periodic(self.keepalive_interval, self.keep_alive)
+        self.add_periodic(diagnostics.SUMMARY_INTERVAL, diagnostics.flush)
+        if self.control_socket:
+            self.start_control_server()
+        if self.metrics_port is not None:
+            self.start_metrics_server()
+        if self.engine is not None:
+            self.engine.add_listener(self.hid_device, self.client_accepted,
+                                     self.client_closed)
+            self.engine.add_input(self.input_device)
+            if self.hosts is not None:
+                self.reconnect_hosts()
+            self.engine.run()
+            return
+        self.start_accepting()
+        if self.hosts is not None:
+            self.reconnect_hosts()
         self.forward_thread = threading.Thread(target=self.input_device.run)
         self.forward_thread.daemon = True
         self.forward_thread.start()
@@ -334,6 +773,50 @@ class Forwarder(object):
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
+    import argparse
     import sys
-    forwarder = Forwarder(sys.path[0])
-    forwarder.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve input and all hosts from a single asyncio loop")
+    parser.add_argument("--latency-log", type=int, default=0, metavar="SECONDS",
+                        help="log input-to-radio latency histograms every SECONDS")
+    parser.add_argument("--keymap", metavar="FILE",
+                        help="keymap file with overrides of the built-in key codes")
+    parser.add_argument("--nkro", action="store_true",
+                        help="send N-key rollover reports to hosts in report protocol")
+    parser.add_argument("--broadcast", nargs="?", const="", metavar="ADDRESSES",
+                        help="mirror input to all hosts, or to a comma separated list")
+    parser.add_argument("--batch", action="store_true",
+                        help="send one set of reports per batch of libinput events")
+    parser.add_argument("--keepalive", type=float, default=DEFAULT_KEEPALIVE_INTERVAL,
+                        metavar="SECONDS",
+                        help="keep idle hosts in active mode with a report every "
+                        "SECONDS, off by default as hosts may then never lock or sleep")
+    parser.add_argument("--profile-channels", action="store_true",
+                        help="let bluetoothd accept the control channel for the profile")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record input events and reports to FILE")
+    parser.add_argument("--control-socket", metavar="PATH",
+                        help="serve the control API on a Unix socket at PATH")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    args = parser.parse_args()
+    recorder = None
+    if args.record:
+        import recording
+        recorder = recording.Recorder(args.record)
+    broadcast_addresses = None
+    if args.broadcast is not None:
+        broadcast_addresses = [address for address in args.broadcast.split(",") if address]
+    forwarder = Forwarder(sys.path[0], use_asyncio=args.asyncio,
+                          latency_interval=args.latency_log, keymap_file=args.keymap,
+                          nkro=args.nkro, broadcast_addresses=broadcast_addresses,
+                          batch=args.batch, keepalive_interval=args.keepalive,
+                          profile_channels=args.profile_channels, recorder=recorder,
+                          control_socket=args.control_socket,
+                          metrics_port=args.metrics_port)
+    try:
+        forwarder.run()
+    finally:
+        if recorder is not None:
+            recorder.close()
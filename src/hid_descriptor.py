@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""The HID report descriptor and the layout of every report, defined once.
+
+The descriptor bytes in the SDP record and descriptor.txt are generated
+from DESCRIPTOR, and validate() checks that every Report packer has the
+size the descriptor gives its report. Run this module to regenerate
+descriptor.txt and the descriptor in sdp_record.xml after a change.
+"""
+
+import os
+import re
+import struct
+import sys
+
+# Main item flags, see HID 1.11 6.2.2.5.
+CONST = 0x01
+VAR = 0x02
+REL = 0x04
+DATA_ARRAY_ABS = 0x00
+DATA_VAR_ABS = VAR
+CONST_VAR_ABS = CONST | VAR
+DATA_VAR_REL = VAR | REL
+
+FLAG_NAMES = (("Data", "Const"), ("Array", "Var"), ("Abs", "Rel"), ("No Wrap", "Wrap"),
+              ("Linear", "Nonlinear"), ("Preferred State", "No Preferred State"),
+              ("No Null Position", "Null State"), ("Non-volatile", "Volatile"))
+
+COLLECTION_NAMES = {0x00: "Physical", 0x01: "Application", 0x02: "Logical"}
+
+PAGE_GENERIC_DESKTOP = 0x01
+PAGE_KEYBOARD = 0x07
+PAGE_LEDS = 0x08
+PAGE_BUTTON = 0x09
+PAGE_CONSUMER = 0x0c
+
+PAGE_NAMES = {
+    PAGE_GENERIC_DESKTOP: "Generic Desktop Ctrls",
+    PAGE_KEYBOARD: "Kbrd/Keypad",
+    PAGE_LEDS: "LEDs",
+    PAGE_BUTTON: "Button",
+    PAGE_CONSUMER: "Consumer",
+}
+
+USAGE_NAMES = {
+    PAGE_GENERIC_DESKTOP: {0x01: "Pointer", 0x02: "Mouse", 0x06: "Keyboard", 0x30: "X",
+                           0x31: "Y", 0x38: "Wheel", 0x48: "Resolution Multiplier"},
+    PAGE_LEDS: {0x01: "Num Lock", 0x05: "Kana"},
+    PAGE_CONSUMER: {0x01: "Consumer Control", 0x30: "Power", 0xb5: "Scan Next Track",
+                    0xb6: "Scan Previous Track", 0xb7: "Stop", 0xcd: "Play/Pause",
+                    0xe2: "Mute", 0xe9: "Volume Increment", 0xea: "Volume Decrement",
+                    0x1b1: "AL Screen Saver", 0x221: "AC Search", 0x223: "AC Home",
+                    0x238: "AC Pan"},
+}
+
+# Item types and tags, see HID 1.11 6.2.2.
+TYPE_MAIN = 0
+TYPE_GLOBAL = 1
+TYPE_LOCAL = 2
+
+TAG_INPUT = 0x8
+TAG_OUTPUT = 0x9
+TAG_COLLECTION = 0xa
+TAG_FEATURE = 0xb
+TAG_END_COLLECTION = 0xc
+TAG_USAGE_PAGE = 0x0
+TAG_LOGICAL_MINIMUM = 0x1
+TAG_LOGICAL_MAXIMUM = 0x2
+TAG_PHYSICAL_MINIMUM = 0x3
+TAG_PHYSICAL_MAXIMUM = 0x4
+TAG_REPORT_SIZE = 0x7
+TAG_REPORT_ID = 0x8
+TAG_REPORT_COUNT = 0x9
+TAG_USAGE = 0x0
+TAG_USAGE_MINIMUM = 0x1
+TAG_USAGE_MAXIMUM = 0x2
+
+# HIDP report types, the low bits of a DATA header.
+REPORT_TYPE_INPUT = 0x01
+REPORT_TYPE_OUTPUT = 0x02
+REPORT_TYPE_FEATURE = 0x03
+
+MAIN_REPORT_TYPES = {
+    TAG_INPUT: REPORT_TYPE_INPUT,
+    TAG_OUTPUT: REPORT_TYPE_OUTPUT,
+    TAG_FEATURE: REPORT_TYPE_FEATURE,
+}
+
+HIDP_DATA = 0xa0
+
+class Item(object):
+    """A short item of the report descriptor."""
+
+    def __init__(self, item_type, tag, value=None, signed=False):
+        self.item_type = item_type
+        self.tag = tag
+        self.value = value
+        self.signed = signed
+
+    def encode(self):
+        if self.value is None:
+            data = b""
+        else:
+            for size in (1, 2, 4):
+                try:
+                    data = self.value.to_bytes(size, "little", signed=self.signed)
+                    break
+                except OverflowError:
+                    continue
+        size_code = (0, 1, 2, None, 3)[len(data)]
+        return bytes([self.tag << 4 | self.item_type << 2 | size_code]) + data
+
+def usage_page(page): return Item(TYPE_GLOBAL, TAG_USAGE_PAGE, page)
+def logical_minimum(value): return Item(TYPE_GLOBAL, TAG_LOGICAL_MINIMUM, value, True)
+def logical_maximum(value): return Item(TYPE_GLOBAL, TAG_LOGICAL_MAXIMUM, value, True)
+def physical_minimum(value): return Item(TYPE_GLOBAL, TAG_PHYSICAL_MINIMUM, value, True)
+def physical_maximum(value): return Item(TYPE_GLOBAL, TAG_PHYSICAL_MAXIMUM, value, True)
+def report_size(bits): return Item(TYPE_GLOBAL, TAG_REPORT_SIZE, bits)
+def report_id(report_id): return Item(TYPE_GLOBAL, TAG_REPORT_ID, report_id)
+def report_count(count): return Item(TYPE_GLOBAL, TAG_REPORT_COUNT, count)
+def usage(usage): return Item(TYPE_LOCAL, TAG_USAGE, usage)
+def usage_minimum(usage): return Item(TYPE_LOCAL, TAG_USAGE_MINIMUM, usage)
+def usage_maximum(usage): return Item(TYPE_LOCAL, TAG_USAGE_MAXIMUM, usage)
+def collection(kind): return Item(TYPE_MAIN, TAG_COLLECTION, kind)
+def end_collection(): return Item(TYPE_MAIN, TAG_END_COLLECTION)
+def input_item(flags): return Item(TYPE_MAIN, TAG_INPUT, flags)
+def output_item(flags): return Item(TYPE_MAIN, TAG_OUTPUT, flags)
+def feature_item(flags): return Item(TYPE_MAIN, TAG_FEATURE, flags)
+
+class Report(object):
+    """Layout of one report as sent on the HIDP channels: the DATA header,
+    the report ID, then the fields in fields_format (struct syntax)."""
+
+    def __init__(self, report_type, report_id, fields_format, boot=False):
+        self.report_type = report_type
+        self.report_id = report_id
+        self.header = HIDP_DATA | report_type
+        self.struct = struct.Struct("<BB" + fields_format)
+        self.size = self.struct.size
+        # Boot protocol reports have a fixed layout, not described by the
+        # report descriptor.
+        self.boot = boot
+
+    def pack(self, *fields):
+        return self.struct.pack(self.header, self.report_id, *fields)
+
+    def unpack(self, message):
+        return self.struct.unpack_from(message)[2:]
+
+    def buffer(self):
+        """A zeroed report to be updated in place."""
+        buf = bytearray(self.size)
+        buf[0] = self.header
+        buf[1] = self.report_id
+        return buf
+
+# modifiers, reserved, 6 key slots
+KEYBOARD = Report(REPORT_TYPE_INPUT, 0x01, "Bx6s")
+# Num Lock, Caps Lock, Scroll Lock, Compose, Kana
+LEDS = Report(REPORT_TYPE_OUTPUT, 0x01, "B")
+# bitmap of media keys, see bt_keyboard.MEDIA_KEY_REPORT_POS
+MEDIA = Report(REPORT_TYPE_INPUT, 0x02, "Hx")
+# buttons, dx, dy, wheel, AC pan
+MOUSE = Report(REPORT_TYPE_INPUT, 0x03, "Hhhbb")
+# modifiers, bitmap of keyboard usages 0x00 ~ 0xDF
+NKRO = Report(REPORT_TYPE_INPUT, 0x04, "B28s")
+# wheel multiplier in bits 0-1, AC pan multiplier in bits 2-3
+RESOLUTION = Report(REPORT_TYPE_FEATURE, 0x05, "B")
+# buttons 1-3, dx, dy
+BOOT_MOUSE = Report(REPORT_TYPE_INPUT, 0x02, "Bbb", boot=True)
+
+REPORTS = (KEYBOARD, LEDS, MEDIA, MOUSE, NKRO, RESOLUTION, BOOT_MOUSE)
+
+def modifier_items():
+    return [
+        report_size(1),
+        report_count(8),
+        usage_page(PAGE_KEYBOARD),
+        usage_minimum(0xe0),
+        usage_maximum(0xe7),
+        logical_minimum(0),
+        logical_maximum(1),
+        input_item(DATA_VAR_ABS),
+    ]
+
+def scroll_items(name, axis_items):
+    """A wheel axis with its resolution multiplier, which goes in its own
+    logical collection so it only applies to that axis."""
+    return [name,
+        collection(0x02),
+        report_id(RESOLUTION.report_id),
+        usage(0x48),
+    ] + ([report_count(1)] if name.startswith("Wheel") else []) + [
+        report_size(2),
+        logical_minimum(0),
+        logical_maximum(1),
+        physical_minimum(1),
+        physical_maximum(8),
+        feature_item(DATA_VAR_ABS),
+        report_id(MOUSE.report_id),
+        physical_minimum(0),
+        physical_maximum(0),
+        report_size(8),
+        logical_minimum(-127),
+        logical_maximum(127),
+    ] + axis_items + [
+        input_item(DATA_VAR_REL),
+        end_collection(),
+    ]
+
+# Items of the report descriptor. A string starts a commented section, and
+# BLANK separates top level collections in descriptor.txt.
+BLANK = None
+
+DESCRIPTOR = [
+    usage_page(PAGE_GENERIC_DESKTOP),
+    usage(0x06),
+    collection(0x01),
+    report_id(KEYBOARD.report_id),
+    "Modifiers",
+] + modifier_items() + [
+    "Padding",
+    report_count(1),
+    report_size(8),
+    input_item(CONST_VAR_ABS),
+    "LEDs",
+    report_count(5),
+    report_size(1),
+    usage_page(PAGE_LEDS),
+    usage_minimum(0x01),
+    usage_maximum(0x05),
+    output_item(DATA_VAR_ABS),
+    "Padding",
+    report_count(1),
+    report_size(3),
+    output_item(CONST_VAR_ABS),
+    "Keys, 6 max",
+    report_count(6),
+    report_size(8),
+    logical_minimum(0),
+    logical_maximum(255),
+    usage_page(PAGE_KEYBOARD),
+    usage_minimum(0x00),
+    usage_maximum(0xff),
+    input_item(DATA_ARRAY_ABS),
+    end_collection(),
+    BLANK,
+    usage_page(PAGE_CONSUMER),
+    usage(0x01),
+    collection(0x01),
+    report_id(MEDIA.report_id),
+    "Media Keys",
+    logical_minimum(0),
+    logical_maximum(1),
+    report_size(1),
+    report_count(11),
+    usage(0x223),
+    usage(0x221),
+    usage(0x1b1),
+    usage(0xb7),
+    usage(0xb6),
+    usage(0xcd),
+    usage(0xb5),
+    usage(0xe2),
+    usage(0xea),
+    usage(0xe9),
+    usage(0x30),
+    input_item(DATA_VAR_ABS),
+    "Padding",
+    report_count(1),
+    report_size(13),
+    input_item(CONST_VAR_ABS),
+    end_collection(),
+    BLANK,
+    usage_page(PAGE_GENERIC_DESKTOP),
+    usage(0x02),
+    collection(0x01),
+    usage(0x01),
+    collection(0x00),
+    report_id(MOUSE.report_id),
+    "Mouse Buttons",
+    report_count(16),
+    report_size(1),
+    logical_minimum(0),
+    logical_maximum(1),
+    usage_page(PAGE_BUTTON),
+    usage_minimum(0x01),
+    usage_maximum(0x10),
+    input_item(DATA_VAR_ABS),
+    "Movement",
+    report_count(2),
+    report_size(16),
+    logical_minimum(-32767),
+    logical_maximum(32767),
+    usage_page(PAGE_GENERIC_DESKTOP),
+    usage(0x30),
+    usage(0x31),
+    input_item(DATA_VAR_REL),
+] + scroll_items("Wheel, with resolution multiplier", [
+    usage(0x38),
+]) + scroll_items("AC Pan, with resolution multiplier", [
+    usage_page(PAGE_CONSUMER),
+    usage(0x238),
+]) + [
+    "Padding of the resolution multiplier feature report",
+    report_id(RESOLUTION.report_id),
+    report_size(4),
+    feature_item(CONST_VAR_ABS),
+    end_collection(),
+    end_collection(),
+    BLANK,
+    usage_page(PAGE_GENERIC_DESKTOP),
+    usage(0x06),
+    collection(0x01),
+    report_id(NKRO.report_id),
+    "Modifiers",
+] + modifier_items() + [
+    "Keys, N-key rollover bitmap",
+    report_count(224),
+    report_size(1),
+    usage_minimum(0x00),
+    usage_maximum(0xdf),
+    input_item(DATA_VAR_ABS),
+    end_collection(),
+]
+
+def encode(descriptor=DESCRIPTOR):
+    return b"".join(item.encode() for item in descriptor if isinstance(item, Item))
+
+def describe(item, page):
+    """Text of an item, as shown by the usual descriptor parsers."""
+    if item.item_type == TYPE_MAIN:
+        if item.tag == TAG_COLLECTION:
+            return "Collection (%s)" % COLLECTION_NAMES[item.value]
+        if item.tag == TAG_END_COLLECTION:
+            return "End Collection"
+        name = {TAG_INPUT: "Input", TAG_OUTPUT: "Output", TAG_FEATURE: "Feature"}[item.tag]
+        flags = FLAG_NAMES if item.tag != TAG_INPUT else FLAG_NAMES[:-1]
+        return "%s (%s)" % (name, ",".join(names[(item.value >> bit) & 1]
+                                           for bit, names in enumerate(flags)))
+    if item.item_type == TYPE_LOCAL:
+        name = {TAG_USAGE: "Usage", TAG_USAGE_MINIMUM: "Usage Minimum",
+                TAG_USAGE_MAXIMUM: "Usage Maximum"}[item.tag]
+        usage_name = USAGE_NAMES.get(page, {}).get(item.value)
+        if usage_name is None:
+            usage_name = "0x%02X" % item.value
+        return "%s (%s)" % (name, usage_name)
+    if item.tag == TAG_USAGE_PAGE:
+        return "Usage Page (%s)" % PAGE_NAMES[item.value]
+    name = {TAG_LOGICAL_MINIMUM: "Logical Minimum", TAG_LOGICAL_MAXIMUM: "Logical Maximum",
+            TAG_PHYSICAL_MINIMUM: "Physical Minimum", TAG_PHYSICAL_MAXIMUM: "Physical Maximum",
+            TAG_REPORT_SIZE: "Report Size", TAG_REPORT_ID: "Report ID",
+            TAG_REPORT_COUNT: "Report Count"}[item.tag]
+    return "%s (%d)" % (name, item.value)
+
+def format_text(descriptor=DESCRIPTOR):
+    """The commented listing kept in descriptor.txt."""
+    lines = []
+    depth = 0
+    page = None
+    for item in descriptor:
+        if item is BLANK:
+            lines.append("")
+            continue
+        if isinstance(item, str):
+            lines.append("")
+            lines.append("// %s" % item)
+            continue
+        if item.tag == TAG_END_COLLECTION and item.item_type == TYPE_MAIN:
+            depth -= 1
+        if item.item_type == TYPE_GLOBAL and item.tag == TAG_USAGE_PAGE:
+            page = item.value
+        data = "".join("0x%02X, " % byte for byte in item.encode())
+        lines.append("%-19s// %s%s" % (data.rstrip(), "  " * depth, describe(item, page)))
+        if item.tag == TAG_COLLECTION and item.item_type == TYPE_MAIN:
+            depth += 1
+    return "\n".join(lines) + "\n"
+
+def parse_report_sizes(data):
+    """Size in bits of every (report type, report ID) described by the
+    descriptor bytes."""
+    sizes = {}
+    size = count = report = 0
+    pos = 0
+    while pos < len(data):
+        prefix = data[pos]
+        length = (0, 1, 2, 4)[prefix & 0x03]
+        value = int.from_bytes(data[pos + 1:pos + 1 + length], "little")
+        pos += 1 + length
+        item_type = (prefix >> 2) & 0x03
+        tag = prefix >> 4
+        if item_type == TYPE_GLOBAL:
+            if tag == TAG_REPORT_SIZE:
+                size = value
+            elif tag == TAG_REPORT_COUNT:
+                count = value
+            elif tag == TAG_REPORT_ID:
+                report = value
+        elif item_type == TYPE_MAIN and tag in MAIN_REPORT_TYPES:
+            key = (MAIN_REPORT_TYPES[tag], report)
+            sizes[key] = sizes.get(key, 0) + size * count
+    return sizes
+
+def validate(descriptor=DESCRIPTOR, reports=REPORTS):
+    """Raise ValueError unless every report in the descriptor has a packer
+    of the same size."""
+    sizes = parse_report_sizes(encode(descriptor))
+    for report in reports:
+        if report.boot: continue
+        key = (report.report_type, report.report_id)
+        bits = sizes.pop(key, None)
+        # The packer also covers the DATA header and the report ID.
+        if bits is None or bits != (report.size - 2) * 8:
+            raise ValueError("Report %d of type %d: descriptor has %s bits, packer %d" % (
+                report.report_id, report.report_type, bits, (report.size - 2) * 8))
+    if sizes:
+        raise ValueError("No packer for reports %r" % sorted(sizes))
+
+def service_record(template):
+    """The SDP record template with the generated report descriptor."""
+    return re.sub(r'(<text encoding="hex" value=")[0-9a-f]*(")',
+                  lambda m: m.group(1) + encode().hex() + m.group(2), template)
+
+if __name__ == "__main__":
+    validate()
+    data_dir = sys.path[0]
+    with open(os.path.join(data_dir, "descriptor.txt"), "w") as f:
+        f.write(format_text())
+    record_filename = os.path.join(data_dir, "sdp_record.xml")
+    with open(record_filename) as f:
+        record = service_record(f.read())
+    with open(record_filename, "w") as f:
+        f.write(record)
+    print("%d byte descriptor, %d reports" % (len(encode()), len(REPORTS)))
@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+HOSTS_FILENAME = "hosts.json"
+
+# Hosts beyond this many are forgotten, least recently used first.
+MAX_HOSTS = 16
+
+class HostRegistry(object):
+    """Hosts that connected before, most recently used first.
+
+    The file holds a compact JSON list of [address, protocol] pairs in that
+    order. It is rewritten by a writer thread whenever it changes, so
+    switching hosts does not wait for the disk."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.dirty = False
+        self.writer = None
+        self.hosts = []
+        self.protocols = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error("Failed to load %s: %s", self.filename, e)
+            return
+        if not isinstance(entries, list):
+            logger.error("Failed to load %s: not a list of hosts", self.filename)
+            return
+        for entry in entries[:MAX_HOSTS]:
+            if not (isinstance(entry, list) and len(entry) == 2 and
+                    isinstance(entry[0], str) and isinstance(entry[1], int)):
+                logger.error("Invalid host entry %r", entry)
+                continue
+            address, protocol = entry
+            if address in self.protocols: continue
+            self.hosts.append(address)
+            self.protocols[address] = protocol
+        logger.info("Loaded %d known hosts", len(self.hosts))
+
+    def save(self):
+        """Have the writer thread rewrite the file, with the lock held."""
+        self.dirty = True
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_worker, name="hosts")
+            self.writer.daemon = True
+            self.writer.start()
+        self.changed.notify()
+
+    def write_worker(self):
+        while True:
+            # Changes made while writing are coalesced into the next write.
+            with self.lock:
+                while not self.dirty:
+                    self.changed.wait()
+                self.dirty = False
+                entries = [[address, self.protocols[address]] for address in self.hosts]
+            self.write(entries)
+
+    def write(self, entries):
+        temp_filename = self.filename + ".tmp"
+        try:
+            with open(temp_filename, "w") as f:
+                json.dump(entries, f, separators=(",", ":"))
+            os.replace(temp_filename, self.filename)
+        except OSError as e:
+            logger.error("Failed to save %s: %s", self.filename, e)
+
+    def get_hosts(self):
+        with self.lock:
+            return list(self.hosts)
+
+    def add(self, address, protocol):
+        """Remember a host, without changing the order of known ones."""
+        with self.lock:
+            if address in self.protocols: return
+            self.hosts.append(address)
+            self.protocols[address] = protocol
+            self.trim()
+            self.save()
+
+    def use(self, address, protocol):
+        """Move a host to the front, as the most recently used one."""
+        with self.lock:
+            if self.hosts and self.hosts[0] == address: return
+            if address in self.protocols:
+                self.hosts.remove(address)
+            else:
+                self.protocols[address] = protocol
+            self.hosts.insert(0, address)
+            self.trim()
+            self.save()
+
+    def remove(self, address):
+        with self.lock:
+            if address not in self.protocols: return
+            self.hosts.remove(address)
+            del self.protocols[address]
+            self.save()
+
+    def set_protocol(self, address, protocol):
+        with self.lock:
+            if self.protocols.get(address, protocol) == protocol: return
+            self.protocols[address] = protocol
+            self.save()
+
+    def trim(self):
+        for address in self.hosts[MAX_HOSTS:]:
+            del self.protocols[address]
+        del self.hosts[MAX_HOSTS:]
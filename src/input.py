@@ -1,46 +1,99 @@
 #!/usr/bin/env python3
 
 from libinput import LibInput
-from libinput.constant import Event, DeviceCapability, PointerAxis, KeyState, ButtonState
+from libinput.event import Event as LibInputEvent
+from libinput.constant import Event, DeviceCapability, PointerAxis, PointerAxisSource
+from libinput.constant import KeyState, ButtonState
 import sys
+import select
+import socket
 import logging
+import collections
 
 logger = logging.getLogger(__name__)
 
+# Continuous scroll sources (touchpads) report in the same units as a wheel,
+# where one notch is 15 degrees.
+SCROLL_UNITS_PER_NOTCH = 15.0
+
+DISCRETE_AXIS_SOURCES = (PointerAxisSource.WHEEL, PointerAxisSource.WHEEL_TILT)
+
+def check_libinput_api(li):
+    """Fail early unless li exposes the handles dispatch_pending() needs.
+
+    LibInput.get_event() of python-libinput 0.1.0 can not drain the queue:
+    it spins forever with timeout=0, and only stops after a positive timeout
+    by waiting that long. So events are read with libinput_dispatch() and
+    libinput_get_event() directly, from the context handle and the library
+    LibInput keeps as _li and _libinput."""
+    library = getattr(li, "_libinput", None)
+    if getattr(li, "_li", None) is None or library is None:
+        raise RuntimeError("Unsupported python-libinput: no _li/_libinput in LibInput")
+    for function in ("libinput_get_fd", "libinput_dispatch", "libinput_get_event"):
+        if not hasattr(library, function):
+            raise RuntimeError("Unsupported libinput: %s is missing" % function)
+
+class DeviceInfo(object):
+    """What we know about an input device, queried once when it is added."""
+
+    def __init__(self, dev):
+        self.device = dev
+        self.name = dev.get_name()
+        self.sysname = dev.get_sysname()
+        self.keyboard = dev.has_capability(DeviceCapability.KEYBOARD)
+        self.pointer = dev.has_capability(DeviceCapability.POINTER)
+
+    def get_type(self):
+        dev_type = ''
+        if self.keyboard:
+            dev_type += '+keyboard'
+        if self.pointer:
+            dev_type += '+mouse'
+        return dev_type
+
 class Input(object):
-    def __init__(self):
-        self.li = LibInput(udev=True)
-        self.li.udev_assign_seat('seat0')
-        self.collect_devices()
+    def __init__(self, latency=None):
+        self.latency = latency
         self.key_callback = None
         self.mouse_move_callback = None
         self.mouse_button_callback = None
         self.mouse_wheel_callback = None
+        self.batch_begin_callback = None
+        self.batch_end_callback = None
         self.event_handlers = {
+            Event.DEVICE_ADDED: self.handle_device_added,
+            Event.DEVICE_REMOVED: self.handle_device_removed,
             Event.KEYBOARD_KEY: self.handle_key_event,
             Event.POINTER_MOTION: self.handle_pointer_motion,
             Event.POINTER_BUTTON: self.handle_pointer_button,
             Event.POINTER_AXIS: self.handle_pointer_axis,
         }
+        # sysname -> DeviceInfo, kept up to date as devices come and go.
+        self.devices = {}
+        # Callbacks other threads queued for run(), see call_soon_threadsafe().
+        self.calls = collections.deque()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.li = LibInput(udev=True)
+        check_libinput_api(self.li)
+        self.fd = self.li._libinput.libinput_get_fd(self.li._li)
+        self.li.udev_assign_seat('seat0')
+        self.collect_devices()
 
     def collect_devices(self):
-        self.devices = {}
-        while True:
-            got_event = False
-            try:
-                for event in self.li.get_event(timeout=0.001):
-                    got_event = True
-                    if event.type == Event.DEVICE_ADDED:
-                        dev = event.get_device()
-                        dev_type = ''
-                        if dev.has_capability(DeviceCapability.KEYBOARD):
-                            dev_type += '+keyboard'
-                        if dev.has_capability(DeviceCapability.POINTER):
-                            dev_type += '+mouse'
-                        logger.info("Device added: %s %s", dev.get_name(), dev_type)
-                        self.devices[dev.get_sysname()] = dev
-            except RuntimeError:
-                if not got_event: break
+        """Handle the DEVICE_ADDED events libinput queued when the seat was
+        assigned. Later devices are picked up by run() as they are plugged."""
+        self.dispatch_pending()
+
+    def handle_device_added(self, event):
+        info = DeviceInfo(event.get_device())
+        logger.info("Device added: %s %s", info.name, info.get_type())
+        self.devices[info.sysname] = info
+
+    def handle_device_removed(self, event):
+        info = self.devices.pop(event.get_device().get_sysname(), None)
+        if info is not None:
+            logger.info("Device removed: %s %s", info.name, info.get_type())
 
     def register_callbacks(self, key_callback, mouse_move_callback,
                            mouse_button_callback, mouse_wheel_callback):
@@ -49,20 +102,33 @@ class Input(object):
         self.mouse_button_callback = mouse_button_callback
         self.mouse_wheel_callback = mouse_wheel_callback
 
+    def register_batch_callbacks(self, batch_begin_callback, batch_end_callback):
+        """Get called around every group of events read from libinput at
+        once, so the resulting reports can be flushed together."""
+        self.batch_begin_callback = batch_begin_callback
+        self.batch_end_callback = batch_end_callback
+
+    def begin_latency(self, event_type, event):
+        if self.latency is not None:
+            self.latency.begin(event_type, event.get_time_usec() / 1e6)
+
     def handle_key_event(self, event):
         kbd_event = event.get_keyboard_event()
+        self.begin_latency("key", kbd_event)
         if self.key_callback:
             self.key_callback(kbd_event.get_key(),
                               kbd_event.get_key_state() == KeyState.PRESSED)
 
     def handle_pointer_motion(self, event):
         motion_event = event.get_pointer_event()
+        self.begin_latency("motion", motion_event)
         if self.mouse_move_callback:
             self.mouse_move_callback(motion_event.get_dx(),
                                         motion_event.get_dy())
 
     def handle_pointer_button(self, event):
         button_event = event.get_pointer_event()
+        self.begin_latency("button", button_event)
         if self.mouse_button_callback:
             self.mouse_button_callback(
                 button_event.get_button(),
@@ -71,17 +137,68 @@ class Input(object):
     def handle_pointer_axis(self, event):
         axis_event = event.get_pointer_event()
         if not self.mouse_wheel_callback: return
-        if axis_event.has_axis(PointerAxis.SCROLL_VERTICAL):
-            self.mouse_wheel_callback(
-                axis_event.get_axis_value(PointerAxis.SCROLL_VERTICAL), 0)
-        if axis_event.has_axis(PointerAxis.SCROLL_HORIZONTAL):
-            self.mouse_wheel_callback(
-                0, axis_event.get_axis_value(PointerAxis.SCROLL_HORIZONTAL))
+        self.begin_latency("axis", axis_event)
+        discrete = axis_event.get_axis_source() in DISCRETE_AXIS_SOURCES
+        dv = self.get_scroll(axis_event, PointerAxis.SCROLL_VERTICAL, discrete)
+        dh = self.get_scroll(axis_event, PointerAxis.SCROLL_HORIZONTAL, discrete)
+        if dv or dh:
+            self.mouse_wheel_callback(dv, dh)
+
+    def get_scroll(self, axis_event, axis, discrete):
+        """Scroll amount on axis in wheel notches, possibly fractional."""
+        if not axis_event.has_axis(axis):
+            return 0
+        if discrete:
+            return axis_event.get_axis_value_discrete(axis)
+        return axis_event.get_axis_value(axis) / SCROLL_UNITS_PER_NOTCH
+
+    def fileno(self):
+        return self.fd
+
+    def dispatch_pending(self):
+        """Handle every event that is already queued, without blocking."""
+        library = self.li._libinput
+        handle = self.li._li
+        if self.batch_begin_callback:
+            self.batch_begin_callback()
+        try:
+            library.libinput_dispatch(handle)
+            while True:
+                event_handle = library.libinput_get_event(handle)
+                if not event_handle: break
+                # Destroys the libinput event once it is collected.
+                self.handle_event(LibInputEvent(event_handle, library))
+        finally:
+            if self.batch_end_callback:
+                self.batch_end_callback()
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Run callback on the thread of run(), between two batches of
+        events, so it can use the clients like the input callbacks do."""
+        self.calls.append((callback, args))
+        self.wakeup_writer.send(b"\0")
+
+    def run_calls(self):
+        try:
+            while self.wakeup_reader.recv(64): pass
+        except BlockingIOError:
+            pass
+        while self.calls:
+            callback, args = self.calls.popleft()
+            callback(*args)
 
     def run(self):
+        # Sleep in poll() until libinput or another thread has something for
+        # us, no timeouts.
+        poller = select.poll()
+        poller.register(self.fileno(), select.POLLIN)
+        poller.register(self.wakeup_reader.fileno(), select.POLLIN)
         while True:
-            for event in self.li.get_event():
-                self.handle_event(event)
+            for fd, event in poller.poll():
+                if fd == self.fileno():
+                    self.dispatch_pending()
+                else:
+                    self.run_calls()
 
     def handle_event(self, event):
         if event.type in self.event_handlers:
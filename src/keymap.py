@@ -0,0 +1,85 @@
+import enum
+import logging
+
+logger = logging.getLogger(__name__)
+
+# What a key does once forwarded.
+ACTION_NONE = 0
+ACTION_MODIFIER = 1  # code: modifier bit
+ACTION_KEY = 2       # code: keyboard usage ID
+ACTION_MEDIA = 3     # code: consumer usage ID
+
+ACTION_NAMES = {
+    "none": ACTION_NONE,
+    "modifier": ACTION_MODIFIER,
+    "key": ACTION_KEY,
+    "media": ACTION_MEDIA,
+}
+
+# Highest evdev key code, KEY_MAX in linux/input-event-codes.h.
+KEY_MAX = 0x2ff
+
+NO_ACTION = (ACTION_NONE, 0, False)
+
+def evdev_code(key):
+    if isinstance(key, enum.Enum):
+        return key.value
+    return int(key)
+
+def parse_key(name):
+    if name[0].isdigit():
+        return int(name, 0)
+    from libinput.evcodes import Key
+    return Key[name].value
+
+class Keymap(object):
+    """Dense translation table from evdev key codes to HID actions.
+
+    Every entry is a (action, code, hotkey) tuple, where hotkey tells whether
+    the key takes part in a hub hotkey, so key events can be translated with
+    a single list index."""
+
+    def __init__(self, modifier_codes, key_codes, media_key_codes, hotkeys=()):
+        self.table = [NO_ACTION] * (KEY_MAX + 1)
+        self.hotkeys = set(evdev_code(key) for key in hotkeys)
+        for action, codes in ((ACTION_MODIFIER, modifier_codes),
+                              (ACTION_KEY, key_codes),
+                              (ACTION_MEDIA, media_key_codes)):
+            for key, code in codes.items():
+                self.set(evdev_code(key), action, code)
+        for key in self.hotkeys:
+            self.set(key, *self.table[key][:2])
+
+    def set(self, key, action, code):
+        self.table[key] = (action, code, key in self.hotkeys)
+
+    def lookup(self, key):
+        key = evdev_code(key)
+        if key > KEY_MAX:
+            return NO_ACTION
+        return self.table[key]
+
+    def load(self, filename):
+        """Apply a keymap file on top of the table. Each line maps a key, by
+        name or evdev code, to an action:
+            KEY_CAPSLOCK modifier 0
+            KEY_RIGHTALT key 0x65
+            KEY_F13 media 0xcd
+            KEY_INSERT none
+        """
+        with open(filename) as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.split("#", 1)[0].strip()
+                if not line: continue
+                try:
+                    fields = line.split()
+                    key = parse_key(fields[0])
+                    action = ACTION_NAMES[fields[1]]
+                    code = int(fields[2], 0) if action != ACTION_NONE else 0
+                    if key > KEY_MAX:
+                        raise ValueError("key code out of range")
+                except (IndexError, KeyError, ValueError) as e:
+                    logger.error("%s:%d: invalid mapping %r: %s", filename, line_number, line, e)
+                    continue
+                self.set(key, action, code)
+        logger.info("Loaded keymap %s", filename)
@@ -0,0 +1,175 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Pipeline stages, measured from the libinput event timestamp.
+STAGE_CALLBACK = "callback"
+STAGE_REPORT = "report"
+STAGE_SENT = "sent"
+
+# Every power of two is split in 2^SUB_BUCKET_BITS buckets, which keeps the
+# error of a recorded value under 12.5%.
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+def bucket_index(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+def bucket_value(index):
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return (SUB_BUCKETS + index % SUB_BUCKETS) << shift
+
+class Histogram(object):
+    """Log-linear histogram of latencies in microseconds."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        value = max(int(value), 0)
+        index = bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= threshold:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        return "n=%d p50=%dus p99=%dus max=%dus" % (
+            self.count, self.percentile(50), self.percentile(99), self.max)
+
+class Trace(object):
+    __slots__ = ("event_type", "start")
+
+    def __init__(self, event_type, start):
+        self.event_type = event_type
+        self.start = start
+
+class LatencyTracker(object):
+    """Tracks how long an input event takes to travel through the pipeline.
+
+    Input calls begin() for every libinput event, the later stages call mark()
+    or finish() with the trace they were handed. Coalesced reports (e.g.
+    mouse motion) are attributed to the latest event that went into them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = None
+        # (stage, client, event type) -> Histogram
+        self.histograms = {}
+
+    def begin(self, event_type, event_time=None):
+        """Start a trace. event_time is a CLOCK_MONOTONIC time in seconds,
+        like the libinput event timestamps."""
+        if event_time is None:
+            event_time = time.monotonic()
+        self.current = Trace(event_type, event_time)
+
+    def capture(self):
+        return self.current
+
+    def start(self, event_type):
+        """A trace that starts now, without becoming the current one."""
+        return Trace(event_type, time.monotonic())
+
+    def mark(self, stage, client="*", trace=None):
+        if trace is None:
+            trace = self.current
+        if trace is None:
+            return
+        self.record(stage, client, trace)
+
+    def finish(self, trace, client):
+        if trace is not None:
+            self.record(STAGE_SENT, client, trace)
+
+    def record(self, stage, client, trace):
+        elapsed = (time.monotonic() - trace.start) * 1e6
+        key = (stage, client, trace.event_type)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(elapsed)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def summary(self):
+        with self.lock:
+            return ["%s %s %s: %s" % (stage, client, event_type, histogram.summary())
+                    for (stage, client, event_type), histogram
+                    in sorted(self.histograms.items())]
+
+    def log_summary(self, reset=True):
+        for line in self.summary():
+            logger.info("Latency %s", line)
+        if reset:
+            self.reset()
+
+# Startup milestones, see Timeline.
+MILESTONE_IMPORTED = "imported"
+MILESTONE_INPUT_READY = "input ready"
+MILESTONE_LISTENING = "ready to accept"
+MILESTONE_PROFILE_REGISTERED = "profile registered"
+MILESTONE_FIRST_CONNECTION = "first host connected"
+MILESTONE_FIRST_REPORT = "first report sent"
+
+def process_start_time():
+    """CLOCK_MONOTONIC time the process started at, so the timeline also
+    covers the interpreter start and the imports. Linux only, other systems
+    get the current time."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces, fields are counted after it.
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        now = time.monotonic()
+        return now - max(uptime - start_ticks / os.sysconf("SC_CLK_TCK"), 0.0)
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+class Timeline(object):
+    """Milestones of the startup, in seconds since the process started.
+    Only the first time a milestone is reached counts."""
+
+    def __init__(self, start=None):
+        self.start = process_start_time() if start is None else start
+        self.lock = threading.Lock()
+        # milestone -> seconds since start, in the order they were reached
+        self.milestones = {}
+
+    def mark(self, milestone, when=None):
+        if milestone in self.milestones: return
+        if when is None:
+            when = time.monotonic()
+        with self.lock:
+            if milestone in self.milestones: return
+            self.milestones[milestone] = when - self.start
+        logger.info("Startup: %s after %.3fs", milestone, when - self.start)
+
+    def get_milestones(self):
+        with self.lock:
+            return list(self.milestones.items())
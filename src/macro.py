@@ -0,0 +1,128 @@
+import logging
+import queue
+import threading
+import time
+import bt_mouse
+import hid_descriptor
+
+logger = logging.getLogger(__name__)
+
+MODIFIER_LEFT_SHIFT = 0x02
+
+# Time between two reports of a macro. A host has to see every report on its
+# own, so this should not be shorter than its polling interval.
+DEFAULT_GAP = bt_mouse.DEFAULT_POLL_INTERVAL
+
+# Reports queued for the host after which the macro waits for it to catch up.
+MAX_QUEUED_REPORTS = 4
+
+def build_us_layout():
+    """Character -> (modifiers, keyboard usage ID) for a US layout."""
+    layout = {}
+    for i in range(26):
+        layout[chr(ord("a") + i)] = (0, 0x04 + i)
+        layout[chr(ord("A") + i)] = (MODIFIER_LEFT_SHIFT, 0x04 + i)
+    for i, char in enumerate("1234567890"):
+        layout[char] = (0, 0x1e + i)
+    for i, char in enumerate("!@#$%^&*()"):
+        layout[char] = (MODIFIER_LEFT_SHIFT, 0x1e + i)
+    for usage, plain, shifted in ((0x2d, "-", "_"), (0x2e, "=", "+"), (0x2f, "[", "{"),
+                                  (0x30, "]", "}"), (0x31, "\\", "|"), (0x33, ";", ":"),
+                                  (0x34, "'", '"'), (0x35, "`", "~"), (0x36, ",", "<"),
+                                  (0x37, ".", ">"), (0x38, "/", "?")):
+        layout[plain] = (0, usage)
+        layout[shifted] = (MODIFIER_LEFT_SHIFT, usage)
+    layout["\n"] = (0, 0x28)
+    layout["\t"] = (0, 0x2b)
+    layout[" "] = (0, 0x2c)
+    return layout
+
+US_LAYOUT = build_us_layout()
+
+def encode_keys(modifiers, key):
+    return hid_descriptor.KEYBOARD.pack(modifiers, bytes([key]))
+
+RELEASE_REPORT = encode_keys(0, 0)
+
+def compile_text(text, layout=US_LAYOUT):
+    """Translate text into keyboard reports.
+
+    A key goes straight to the next one when they differ, since a report
+    that releases one key and presses another types both. Only repeated keys
+    need a release in between. Characters missing from layout are skipped."""
+    reports = []
+    previous = None
+    for char in text:
+        keys = layout.get(char)
+        if keys is None:
+            logger.warning("No key for %r", char)
+            continue
+        if keys[1] == (previous[1] if previous else None):
+            reports.append(RELEASE_REPORT)
+        reports.append(encode_keys(*keys))
+        previous = keys
+    if reports:
+        reports.append(RELEASE_REPORT)
+    return reports
+
+class MacroPlayer(object):
+    """Types text into a client from a worker thread, one report every gap
+    seconds, so callers do not wait for it."""
+
+    def __init__(self, hid_client, gap=DEFAULT_GAP, layout=US_LAYOUT):
+        self.hid_client = hid_client
+        self.gap = gap
+        self.layout = layout
+        self.queue = queue.Queue()
+        # Characters per second of the last finished macro.
+        self.last_rate = 0.0
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def type(self, text, done_callback=None):
+        """Queue text to be typed. done_callback, if any, is called with the
+        achieved characters per second once it is typed."""
+        reports = compile_text(text, self.layout)
+        self.queue.put((reports, len(text), done_callback))
+
+    def wait_for_host(self):
+        sender = self.hid_client.interrupt_client_sender
+        while sender.depth() >= MAX_QUEUED_REPORTS:
+            time.sleep(self.gap)
+
+    def worker(self):
+        while True:
+            reports, chars, done_callback = self.queue.get()
+            if reports is None: break
+            # A failed macro must not stop the ones queued after it.
+            try:
+                self.play(reports, chars)
+            except Exception:
+                logger.exception("Macro failed")
+                self.last_rate = 0.0
+            if done_callback:
+                done_callback(self.last_rate)
+
+    def play(self, reports, chars):
+        start = time.monotonic()
+        next_time = start
+        for report in reports:
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not self.hid_client.interrupt_client:
+                logger.error("Client closed, macro aborted")
+                break
+            self.wait_for_host()
+            self.hid_client.send_interrupt_message(report)
+            # Scheduled from the previous slot, not from now, so sleep
+            # overshoot does not add up over a long text.
+            next_time = max(next_time + self.gap, time.monotonic())
+        elapsed = time.monotonic() - start
+        self.last_rate = chars / elapsed if elapsed > 0 else 0.0
+        logger.info("Typed %d characters in %.2fs, %.0f chars/sec",
+                    chars, elapsed, self.last_rate)
+
+    def close(self):
+        self.queue.put((None, 0, None))
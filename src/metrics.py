@@ -0,0 +1,144 @@
+"""Counters and gauges of the hub, served as Prometheus text over HTTP.
+
+Counters are plain attributes updated without a lock. Those on the hot path
+are only written by the thread handling input or by the sender of one
+client. Rare ones (errors, reconnects) may be written from several threads,
+where the GIL makes a lost update unlikely enough for monitoring.
+
+Gauges and per-client values are read by callbacks when the endpoint is
+scraped, so they cost nothing in between.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+
+DEFAULT_HOST = "127.0.0.1"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_sample(name, labels, value):
+    if labels:
+        name += "{%s}" % ",".join('%s="%s"' % (key, escape_label(labels[key]))
+                                  for key in sorted(labels))
+    if isinstance(value, bool):
+        value = int(value)
+    return "%s %s" % (name, value)
+
+class Counter(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (type, help), in the order they were declared
+        self.descriptions = {}
+        # (name, labels, Counter)
+        self.counters = []
+        # Callbacks returning (name, labels, value) samples of declared names.
+        self.collectors = []
+        self.start_time = time.time()
+        self.gauge("bthub_start_time_seconds", "When the hub started, in Unix time",
+                   lambda: self.start_time)
+
+    def describe(self, name, metric_type, help_text):
+        with self.lock:
+            self.descriptions.setdefault(name, (metric_type, help_text))
+
+    def counter(self, name, help_text, **labels):
+        self.describe(name, COUNTER, help_text)
+        counter = Counter()
+        with self.lock:
+            self.counters.append((name, labels, counter))
+        return counter
+
+    def gauge(self, name, help_text, callback, **labels):
+        """A gauge whose value is callback(), read when scraped."""
+        self.describe(name, GAUGE, help_text)
+        self.add_collector(lambda: [(name, labels, callback())])
+
+    def add_collector(self, callback):
+        with self.lock:
+            self.collectors.append(callback)
+
+    def samples(self):
+        with self.lock:
+            samples = [(name, labels, counter.value) for name, labels, counter in self.counters]
+            collectors = list(self.collectors)
+        for collector in collectors:
+            try:
+                samples.extend(collector())
+            except Exception:
+                logger.exception("Metrics collector failed")
+        return samples
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        by_name = {}
+        for name, labels, value in self.samples():
+            by_name.setdefault(name, []).append(format_sample(name, labels, value))
+        lines = []
+        with self.lock:
+            descriptions = list(self.descriptions.items())
+        for name, (metric_type, help_text) in descriptions:
+            if name not in by_name: continue
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            lines.extend(by_name[name])
+        return "\n".join(lines) + "\n"
+
+class MetricsServer(object):
+    """Serves a Registry on http://host:port/metrics from its own thread."""
+
+    def __init__(self, registry, port, host=DEFAULT_HOST):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        # Only loaded when metrics are served.
+        import http.server
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format, *args)
+
+        self.server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        logger.info("Serving metrics on http://%s:%d/metrics", self.host,
+                    self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
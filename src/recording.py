@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Record the input events going into Forwarder and the reports coming out
+of it, and read such recordings back.
+
+A recording is a gzip file starting with MAGIC, followed by records made of
+a one byte kind, the time since the previous record in microseconds as an
+unsigned short, and a payload that depends on the kind. Longer gaps are
+written as KIND_TIME records before the next one.
+
+    recording.py dump FILE
+    recording.py diff FILE FILE
+"""
+
+import argparse
+import gzip
+import logging
+import struct
+import sys
+import threading
+import time
+import keymap
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"BTHUBREC\x01"
+
+KIND_TIME = 0         # delta: I
+KIND_KEY = 1          # evdev code: H, down: B
+KIND_BUTTON = 2       # evdev code: H, down: B
+KIND_MOTION = 3       # dx: f, dy: f
+KIND_WHEEL = 4        # dv: f, dh: f
+KIND_BATCH_BEGIN = 5
+KIND_BATCH_END = 6
+KIND_HOST = 7         # host id: B, length: B, address
+KIND_REPORT = 8       # host id: B, length: B, report
+
+HEADER = struct.Struct("<BH")
+TIME = struct.Struct("<I")
+CODE = struct.Struct("<HB")
+AXES = struct.Struct("<ff")
+BLOB = struct.Struct("<BB")
+
+MAX_DELTA = 0xffff
+MAX_TIME = 0xffffffff
+
+# Buffered records are compressed once this many bytes are waiting.
+FLUSH_SIZE = 64 * 1024
+
+EVENT_TYPES = {
+    KIND_KEY: "key",
+    KIND_BUTTON: "button",
+    KIND_MOTION: "motion",
+    KIND_WHEEL: "wheel",
+}
+
+class Recorder(object):
+    """Writes a recording. Input callbacks are recorded by wrapping them,
+    reports by calling report() before they are queued."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = gzip.open(filename, "wb")
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.last_time = time.monotonic()
+        # remote address -> host id
+        self.hosts = {}
+        # Set when writing failed, recording stops then.
+        self.failed = False
+
+    def write(self, kind, payload=b""):
+        """Append a record. Never raises, since it runs in the input
+        callbacks: a failure is logged and ends the recording."""
+        if self.failed: return
+        with self.lock:
+            try:
+                self.append(kind, payload)
+            except Exception:
+                logger.exception("Recording to %s failed, stopped recording", self.filename)
+                self.failed = True
+
+    def append(self, kind, payload):
+        delta = int((time.monotonic() - self.last_time) * 1e6)
+        # Advanced by what was written, so rounding errors do not add up
+        # over a long recording.
+        self.last_time += delta / 1e6
+        # Gaps too long for one KIND_TIME record take several.
+        while delta > MAX_DELTA:
+            gap = min(delta, MAX_TIME)
+            self.buffer += HEADER.pack(KIND_TIME, 0) + TIME.pack(gap)
+            delta -= gap
+        self.buffer += HEADER.pack(kind, delta)
+        self.buffer += payload
+        if len(self.buffer) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        with self.lock:
+            try:
+                self.flush()
+            finally:
+                self.file.close()
+        logger.info("Saved recording to %s", self.filename)
+
+    def wrap_input(self, key_callback, mouse_move_callback, mouse_button_callback,
+                   mouse_wheel_callback):
+        def key(key, down):
+            self.write(KIND_KEY, CODE.pack(keymap.evdev_code(key), down))
+            key_callback(key, down)
+        def motion(dx, dy):
+            self.write(KIND_MOTION, AXES.pack(dx, dy))
+            mouse_move_callback(dx, dy)
+        def button(button, down):
+            self.write(KIND_BUTTON, CODE.pack(keymap.evdev_code(button), down))
+            mouse_button_callback(button, down)
+        def wheel(dv, dh):
+            self.write(KIND_WHEEL, AXES.pack(dv, dh))
+            mouse_wheel_callback(dv, dh)
+        return key, motion, button, wheel
+
+    def wrap_batch(self, batch_begin_callback=None, batch_end_callback=None):
+        def begin():
+            self.write(KIND_BATCH_BEGIN)
+            if batch_begin_callback: batch_begin_callback()
+        def end():
+            self.write(KIND_BATCH_END)
+            if batch_end_callback: batch_end_callback()
+        return begin, end
+
+    def report(self, remote_address, message):
+        host = self.hosts.get(remote_address)
+        if host is None:
+            host = self.hosts[remote_address] = len(self.hosts) & 0xff
+            address = remote_address.encode()
+            self.write(KIND_HOST, BLOB.pack(host, len(address)) + address)
+        self.write(KIND_REPORT, BLOB.pack(host, len(message)) + bytes(message))
+
+def is_recording(filename):
+    try:
+        with gzip.open(filename, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+def read_records(filename):
+    """Yields (seconds since the start, kind, fields) for every record."""
+    with gzip.open(filename, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("%s is not a recording" % filename)
+    pos = len(MAGIC)
+    now = 0
+    hosts = {}
+    while pos < len(data):
+        kind, delta = HEADER.unpack_from(data, pos)
+        pos += HEADER.size
+        now += delta
+        if kind == KIND_TIME:
+            now += TIME.unpack_from(data, pos)[0]
+            pos += TIME.size
+            continue
+        if kind in (KIND_KEY, KIND_BUTTON):
+            fields = CODE.unpack_from(data, pos)
+            fields = (fields[0], bool(fields[1]))
+            pos += CODE.size
+        elif kind in (KIND_MOTION, KIND_WHEEL):
+            fields = AXES.unpack_from(data, pos)
+            pos += AXES.size
+        elif kind in (KIND_HOST, KIND_REPORT):
+            host, length = BLOB.unpack_from(data, pos)
+            pos += BLOB.size
+            blob = data[pos:pos + length]
+            pos += length
+            if kind == KIND_HOST:
+                hosts[host] = blob.decode()
+                continue
+            fields = (hosts.get(host, str(host)), blob)
+        elif kind in (KIND_BATCH_BEGIN, KIND_BATCH_END):
+            fields = ()
+        else:
+            raise ValueError("Unknown record kind %d at %d" % (kind, pos))
+        yield now / 1e6, kind, fields
+
+def load_events(filename):
+    """Input events of a recording, as the (timestamp, type, args) tuples
+    replayed by benchmark.ReplayInput. Events of a batch share the time
+    the batch began, so they are replayed as one batch."""
+    from libinput.evcodes import Key, Button
+    events = []
+    batch_time = None
+    for timestamp, kind, fields in read_records(filename):
+        if kind == KIND_BATCH_BEGIN:
+            batch_time = timestamp
+        elif kind == KIND_BATCH_END:
+            batch_time = None
+        elif kind in EVENT_TYPES:
+            if kind in (KIND_KEY, KIND_BUTTON):
+                codes = Key if kind == KIND_KEY else Button
+                try:
+                    fields = (codes(fields[0]), fields[1])
+                except ValueError:
+                    pass
+            events.append((timestamp if batch_time is None else batch_time,
+                           EVENT_TYPES[kind], fields))
+    return events
+
+def load_reports(filename):
+    return [fields for timestamp, kind, fields in read_records(filename)
+            if kind == KIND_REPORT]
+
+def dump(filename, out=sys.stdout):
+    for timestamp, kind, fields in read_records(filename):
+        if kind == KIND_REPORT:
+            text = "report %s %s" % (fields[0], fields[1].hex())
+        elif kind == KIND_BATCH_BEGIN:
+            text = "batch begin"
+        elif kind == KIND_BATCH_END:
+            text = "batch end"
+        else:
+            text = "%s %s" % (EVENT_TYPES[kind], " ".join(str(field) for field in fields))
+        out.write("%.6f %s\n" % (timestamp, text))
+
+def diff(filename1, filename2, out=sys.stdout):
+    """Compare the reports of two recordings, host by host in the order they
+    first got a report, so recordings of different hosts can be compared.
+    Returns the number of hosts whose reports differ."""
+    streams = []
+    for filename in (filename1, filename2):
+        by_host = {}
+        for address, report in load_reports(filename):
+            by_host.setdefault(address, []).append(report)
+        streams.append(list(by_host.items()))
+    differences = 0
+    for index in range(max(len(streams[0]), len(streams[1]))):
+        (address1, reports1), (address2, reports2) = [
+            stream[index] if index < len(stream) else ("-", []) for stream in streams]
+        for position, (report1, report2) in enumerate(zip(reports1, reports2)):
+            if report1 != report2:
+                out.write("%s / %s: report %d differs: %s != %s\n" % (
+                    address1, address2, position, report1.hex(), report2.hex()))
+                differences += 1
+                break
+        else:
+            if len(reports1) != len(reports2):
+                out.write("%s / %s: %d != %d reports\n" % (
+                    address1, address2, len(reports1), len(reports2)))
+                differences += 1
+                continue
+            out.write("%s / %s: %d identical reports\n" % (address1, address2, len(reports1)))
+    return differences
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    dump_parser = subparsers.add_parser("dump", help="print every record")
+    dump_parser.add_argument("file")
+    diff_parser = subparsers.add_parser("diff", help="compare the reports of two recordings")
+    diff_parser.add_argument("file1")
+    diff_parser.add_argument("file2")
+    args = parser.parse_args()
+    if args.command == "dump":
+        dump(args.file)
+    else:
+        sys.exit(1 if diff(args.file1, args.file2) else 0)
@@ -0,0 +1,58 @@
+import logging
+import socket
+
+logger = logging.getLogger(__name__)
+
+class L2CAPTransport(object):
+    """HID channels over Bluetooth L2CAP, the transport used in production."""
+
+    def listen(self, port, backlog=1):
+        import bluetooth
+        sock = bluetooth.BluetoothSocket(proto=bluetooth.L2CAP)
+        sock.bind(("", port))
+        sock.listen(backlog)
+        return sock
+
+    def accept(self, sock):
+        """Returns the accepted channel and the remote address of the host."""
+        client, client_info = sock.accept()
+        return client, client_info[0]
+
+    def connect(self, address, port):
+        import bluetooth
+        sock = bluetooth.BluetoothSocket(proto=bluetooth.L2CAP)
+        sock.connect((address, port))
+        return sock
+
+class LoopbackTransport(object):
+    """HID channels over local SOCK_SEQPACKET Unix sockets.
+
+    Like L2CAP, these keep message boundaries, so reports go through the
+    forwarding path unchanged. Sockets live in the abstract namespace: the
+    hub listens on "<prefix>.<port>" and a host binds its end of the channel
+    to "<prefix>.<port>.<address>", which is how accept() learns the remote
+    address used to pair the control and interrupt channels."""
+
+    def __init__(self, prefix="bthub-loopback"):
+        self.prefix = prefix
+
+    def server_name(self, port):
+        return "\0%s.%d" % (self.prefix, port)
+
+    def listen(self, port, backlog=1):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.bind(self.server_name(port))
+        sock.listen(backlog)
+        return sock
+
+    def accept(self, sock):
+        client, client_name = sock.accept()
+        if isinstance(client_name, bytes):
+            client_name = client_name.decode()
+        return client, client_name.split(".", 2)[-1]
+
+    def connect(self, address, port):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.bind("%s.%s" % (self.server_name(port), address))
+        sock.connect(self.server_name(port))
+        return sock